@@ -0,0 +1,59 @@
+import itertools
+import threading
+from concurrent.futures import Future
+from queue import PriorityQueue
+
+# Task priorities. Tasks with lower values are run first, and tasks with equal priority are run in the order they were submitted
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+_PRIORITY_STOP = 3
+
+# Runs submitted callables one at a time on a single thread which it owns.
+# Used to give one thread sole ownership of something that isn't safe to use from several threads at once (e.g. a WebDriver session)
+class Actor():
+    def __init__(self, name='actor'):
+        self._queue = PriorityQueue()
+        # tie-breaker, so that the queue never compares the callables themselves
+        self._counter = itertools.count()
+        self._thread = threading.Thread(name=name, daemon=True, target=self._run)
+        self._thread.start()
+
+    def is_actor_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    # Queues fn(*args, **kwargs) to be run on the actor thread. Returns a Future for its result
+    def submit(self, fn, *args, priority=PRIORITY_NORMAL, **kwargs) -> Future:
+        future = Future()
+        self._queue.put((priority, next(self._counter), fn, args, kwargs, future))
+        return future
+
+    # Runs fn(*args, **kwargs) on the actor thread and waits for its result (or exception).
+    # If called from the actor thread itself, fn is run immediately, so tasks can call other actor-run methods
+    def call(self, fn, *args, priority=PRIORITY_NORMAL, **kwargs):
+        if(self.is_actor_thread()):
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, priority=priority, **kwargs).result()
+
+    # Stops the actor thread once every task already submitted has been run
+    def stop(self) -> None:
+        self._queue.put((_PRIORITY_STOP, next(self._counter), None, (), {}, None))
+        if(not self.is_actor_thread()):
+            self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            _, _, fn, args, kwargs, future = self._queue.get()
+            if(fn == None):
+                return
+            assert isinstance(future, Future)
+            if(not future.set_running_or_notify_cancel()):
+                # cancelled before it was run
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
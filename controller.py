@@ -1,39 +1,70 @@
 from r20 import Roll20
-from messages import MessageLog, Message, MessageTag, SYSTEM_TAGS
+from messages import MessageLog, Message, MessageTag, SYSTEM_TAGS, is_newer_id
 from generator import Generator
 from exceptions import APIError, FileFormatError, Roll20InterfaceError
+from tokenizer import get_token_counter
+from message_store import MessageStore, DEFAULT_CACHE_DIRECTORY
+from retrieval import ContextRetriever
+from ratelimit import get_rate_limiter, EXPECTED_COMPLETION_TOKENS, RATE_LIMIT_POLICY_QUEUE, RATE_LIMIT_POLICY_DROP
+from usage import get_usage_ledger, USAGE_FILE_NAME
+from summary import RollingSummary
+from scheduler import DebounceTimer, PendingReply, MAX_REPLY_RESTARTS
 
 from time import sleep
 from random import random
 import yaml
 import shlex
-import threading
+import os
+from queue import Queue
 
 MESSAGE_POLLING_SLEEP_INTERVAL = 0.5
 NON_SYSTEM_TOKEN_LIMIT = 2000
 OPERATOR_STRING = '%'
 
+# A character played by the bot, and the state of its reply
+class BotCharacter():
+    def __init__(self, name: str, system_prompt: str):
+        self.name = name
+        self.system_prompt = system_prompt
+        # The reply being generated, if there is one
+        self.reply = None
+        # Times the current reply has been restarted because new messages arrived while it was being generated
+        self.reply_restarts = 0
+        self.debounce = DebounceTimer()
+        self.poked = False
+        # Whether the reply is being held back until it's within the rate limit
+        self.rate_limited = False
+
 class Controller():
     # Precondition: Roll20 object must be logged in and ready to go
     def __init__(self, r20: Roll20, gameID: str):
-        self.gen = Generator()
         self.r20 = r20
-        self.msg_log = MessageLog()
         self._tokens_used = 0
         self._gameID = gameID
 
         self._help_strings = {
             'help' : f'USAGE: {OPERATOR_STRING}help\nView command help',
-            'poke' : f'USAGE: {OPERATOR_STRING}poke\nForce the bot to respond.',
-            'character' : f'USAGE: {OPERATOR_STRING}character \'[character\'s display name]\'\nChange which character the bot is controlling.',
-            'system' : f'USAGE: {OPERATOR_STRING}system \'[new system prompt]\'\nChange the system prompt.',
+            'poke' : f'USAGE: {OPERATOR_STRING}poke \'[character\'s display name]\'\nForce the bot to respond as the given character. Omit the character to force every character the bot is playing to respond.',
+            'character' : f'USAGE: {OPERATOR_STRING}character \'[character\'s display name]\'\nChange which character the bot is controlling. The bot stops playing any other characters.',
+            'add' : f'USAGE: {OPERATOR_STRING}add \'[character\'s display name]\'\nStart playing another character, as well as the current ones.',
+            'remove' : f'USAGE: {OPERATOR_STRING}remove \'[character\'s display name]\'\nStop playing a character.',
+            'system' : f'USAGE: {OPERATOR_STRING}system \'[new system prompt]\' \'[character\'s display name]\'\nChange a character\'s system prompt. The character can be omitted if the bot is only playing one.',
             'pause' : f'USAGE: {OPERATOR_STRING}pause\nStop posting in-character until the {OPERATOR_STRING}resume command is given.',
             'resume' : f'USAGE: {OPERATOR_STRING}resume\nContinue posting in-character.',
             'stop' : f'USAGE: {OPERATOR_STRING}stop\nTerminate the program'
         }
 
+        settings = Controller._get_settings_from_file()
+        self.gen = Generator(counter=get_token_counter(settings.get('tokenizer_vocabulary')))
+        cache_directory = settings.get('cache_directory', DEFAULT_CACHE_DIRECTORY)
+        self._usage = get_usage_ledger(os.path.join(cache_directory, USAGE_FILE_NAME))
+        self.msg_log = Controller._create_message_log(gameID=gameID, hot_window=settings.get('message_log_hot_window'), directory=cache_directory)
+
+        # Start queueing new messages before reading the archive so that nothing posted in between is missed.
+        # Any overlap with the archive is discarded in _update_messages
+        r20.start_message_feed()
         # Store all character messages, emotes, narrations
-        self._log_messages(r20.get_all_messages())
+        self._load_archive(max_pages=settings.get('archive_page_limit'))
         # This Message id marks the last message before the latest set of new messages was added.
         self._last_id = None
 
@@ -42,17 +73,26 @@ class Controller():
             print('Could not find the player name of the bot.')
             raise Roll20InterfaceError()
 
-        settings = Controller._get_settings_from_file()
         try:
             if(self._gameID in settings['bot_character_names']):
-                self.character = settings['bot_character_names'][self._gameID]
-                assert isinstance(self.character, str)
+                # Either one name or a list of them
+                names = settings['bot_character_names'][self._gameID]
+                names = ([names] if isinstance(names, str) else names)
+                assert isinstance(names, list) and len(names) > 0 and all(isinstance(name, str) for name in names)
             else:
-                self.character = input(f'settings.yaml specifies no character for this game (gameID={self._gameID}). Enter the name of the character you want the bot to play: ')
+                names = [input(f'settings.yaml specifies no character for this game (gameID={self._gameID}). Enter the name of the character you want the bot to play: ')]
 
-            self.system_prompt = self._get_system_prompt(character=self.character, settings=settings)
+            # The characters the bot is playing, by name, in the order they were added
+            self.characters = {name : BotCharacter(name=name, system_prompt=self._get_system_prompt(character=name, settings=settings)) for name in names}
             
             self.model = settings['model']
+            self.stream_responses = settings.get('stream_responses', False)
+
+            model_limits = settings.get('rate_limits', dict()).get(self.model, dict())
+            self._rate_limiter = get_rate_limiter(model=self.model, requests_per_minute=model_limits.get('requests_per_minute'),
+                                                  tokens_per_minute=model_limits.get('tokens_per_minute'))
+            self._rate_limit_policy = settings.get('rate_limit_policy', RATE_LIMIT_POLICY_QUEUE)
+            assert self._rate_limit_policy in (RATE_LIMIT_POLICY_QUEUE, RATE_LIMIT_POLICY_DROP)
 
             self.use_whitelist = False
             self.use_blacklist = False
@@ -85,8 +125,32 @@ class Controller():
             print('settings.yaml file formatted incorrectly')
             raise e
 
+        # Views of the message log that are read on every poll/generation, kept up to date as messages are logged
+        # All non-system messages
+        self._chat_view = self.msg_log.register_view(tag_blacklist=SYSTEM_TAGS)
+        # Non-system messages from names treated as in-character. Used as prompt history
+        self._history_view = self.msg_log.register_view(tag_blacklist=SYSTEM_TAGS, counter=self.gen.counter,
+                                                        character_whitelist=(self.whitelist if self.use_whitelist else None),
+                                                        character_blacklist=(self.blacklist if self.use_blacklist else None))
+        # Fills part of the prompt with older history relevant to the latest messages
+        self._retrieval_share = settings.get('retrieval_token_share', 0)
+        self._retriever = (ContextRetriever(view=self._history_view, retrieval_share=self._retrieval_share) if self._retrieval_share > 0 else None)
+        # Keeps a summary of the history that no longer fits in the prompt
+        self._summary = None
+        if(settings.get('summarize_history', False)):
+            summary_model = settings.get('summary_model', self.model)
+            summary_limits = settings.get('rate_limits', dict()).get(summary_model, dict())
+            summary_rate_limiter = get_rate_limiter(model=summary_model, requests_per_minute=summary_limits.get('requests_per_minute'),
+                                                    tokens_per_minute=summary_limits.get('tokens_per_minute'))
+            self._summary = RollingSummary(gameID=gameID, directory=cache_directory, view=self._history_view, generator=self.gen,
+                                           model=summary_model, rate_limiter=summary_rate_limiter, usage=self._usage)
+
+        # The character the typing indicator is being shown for, if any
+        self._typing_as = None
+        # The character whose streamed reply is being posted. Other characters' replies wait until it's finished, so that they aren't interleaved
+        self._posting_character = None
+
         # command flags
-        self._poked = False
         self._stopped = False
         self._paused = False
 
@@ -104,6 +168,13 @@ class Controller():
                 raise FileNotFoundError
         return settings
     
+    # Carries on from the game's messages stored on disk, and keeps the latest hot_window of them in memory. If hot_window is None, every message is kept in memory
+    @staticmethod
+    def _create_message_log(gameID: str, hot_window: int|None, directory: str) -> MessageLog:
+        os.makedirs(directory, exist_ok=True)
+        store = MessageStore(os.path.join(directory, f'{gameID}.messages.sqlite3'))
+        return MessageLog(hot_window=hot_window, store=store)
+
     def _get_system_prompt(self, character: str, settings: dict) -> str:
             if(self._gameID in settings['character_descriptions'] and character in settings['character_descriptions'][self._gameID]):
                 system_prompt = settings['character_descriptions'][self._gameID][character]
@@ -117,22 +188,52 @@ class Controller():
             return system_prompt
     
     def _log_message(self, message: list) -> Message:
-        return self.msg_log.append_message(Message(message[0], message[1], message[2], message[3]))
+        return self._log_messages([message])[0]
 
+    # Appends messages to the message log, which also stores them on disk
     def _log_messages(self, messages: list[list]) -> list[Message]:
-        msg_objects = []
-        for message in messages:
-            msg_objects.append(self._log_message(message))
-        return msg_objects
+        return self.msg_log.append_messages([Message(message[0], message[1], message[2], message[3]) for message in messages])
+
+    # Streams any archive messages newer than the ones already stored into the message log, one page at a time
+    def _load_archive(self, max_pages: int|None=None) -> None:
+        last_stored_id = self.msg_log.get_newest_id()
+        if(last_stored_id == None):
+            for page, page_count, messages in self.r20.iter_all_messages(max_pages=max_pages):
+                self._log_messages(messages)
+                print(f'Loaded chat archive page {page}/{page_count}')
+            return
 
-    # Adds new messages to the message log. Returns True iff there are new messages
+        print(f'Loaded {len(self.msg_log)} stored messages')
+        # Read back from the newest page until reaching messages that are already stored
+        new_pages = []
+        pages = self.r20.iter_all_messages(max_pages=max_pages, newest_first=True)
+        for page, page_count, messages in pages:
+            new_messages = [msg for msg in messages if is_newer_id(msg[2], last_stored_id)]
+            new_pages.append(new_messages)
+            print(f'Checked chat archive page {page}/{page_count} ({len(new_messages)} new messages)')
+            if(len(new_messages) < len(messages)):
+                break
+        pages.close()
+
+        for messages in reversed(new_pages):
+            self._log_messages(messages)
+
+    # Adds new messages to the message log. Returns the newly logged messages
     def _update_messages(self, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[Message]:
         ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
 
-        last_msg = self.msg_log.get_last_n_messages(1)
-        if (len(last_msg) > 0):
-            last_msg = last_msg[0]
-            new_msgs = self.r20.get_messages_after_id(last_msg.get_id(), tag_blacklist=ignore_tags)
+        last_msg = self._chat_view.get_last_message()
+        if (last_msg != None):
+            new_msgs = self.r20.drain_new_messages(tag_blacklist=ignore_tags)
+            if(new_msgs == None):
+                # The message feed was lost (e.g. the page reloaded). Restart it and catch up by scanning the chat
+                self.r20.start_message_feed()
+                new_msgs = self.r20.get_messages_after_id(last_msg.get_id(), tag_blacklist=ignore_tags)
+
+            # The feed may have queued messages which were already logged from the archive or a catch-up scan
+            new_ids = [msg[2] for msg in new_msgs]
+            if(last_msg.get_id() in new_ids):
+                new_msgs = new_msgs[new_ids.index(last_msg.get_id())+1:]
 
             logged_messages = self._log_messages(new_msgs)
             self._last_id = last_msg.get_id()
@@ -148,16 +249,16 @@ class Controller():
         return True
 
     # Defines conditions under which the bot should generate a response
-    def _should_respond(self, new_messages) -> bool:
-        # Will never generate a response if the last in-character message was posted by the bot.
-        # Will always generate a response if the bot's name is a substring of one of the new non-bot messages.
+    def _should_respond(self, character: BotCharacter, new_messages) -> bool:
+        # Will never generate a response to messages posted by the bot (as any of its characters), so that its characters don't talk among themselves forever.
+        # Will always generate a response if the character's name is a substring of one of the new non-bot messages.
         # Has a {CHANCE} probability of responding otherwise (you could modify this to get the generator to predict if it should respond, 
         # but that would significantly increase the number of requests)
         CHANCE = 0.5
 
         if(self._paused):
             return False
-        if(self._poked):
+        if(character.poked):
             return True
         if(self._last_id == None):
             # i.e. There are no messages yet
@@ -167,9 +268,9 @@ class Controller():
         
         response_condition = False
         for msg in new_messages:
-            if(self.is_visible(msg) and msg.get_character() != self.character):
+            if(self.is_visible(msg) and msg.get_character() not in self.characters):
                 response_condition = True
-                if(self.character in msg.get_content()):
+                if(character.name in msg.get_content()):
                     # The bot's character was mentioned in this message
                     return True
         if(response_condition):
@@ -187,10 +288,6 @@ class Controller():
     #         return True
     #     return False
 
-    @staticmethod
-    def _counter(chars: int) -> int:
-        return int(chars/4)
-
     def is_operator(self, name: str|None) -> bool:
         if(name == None):
             return False
@@ -224,27 +321,34 @@ class Controller():
                         help += '\nTo get help for an idividual command, type `[command] --help`.'
                         self.notify(help)
 
-                    case "character":
+                    case "character" | "add" | "remove":
                         if(len(args)>1):
-                            self.command_character(name=args[1])
+                            match args[0]:
+                                case "character":
+                                    self.command_character(name=args[1])
+                                case "add":
+                                    self.command_add(name=args[1])
+                                case "remove":
+                                    self.command_remove(name=args[1])
                         else:
                             self.notify(f'Missing argument. Use `{OPERATOR_STRING}{args[0]} --help` for help with this command.')
                         if(len(args)>2):
                             self.notify(f'{len(args)-2} more arguments than expected were supplied. Make sure any quote marks in the supplied system prompt are properly escaped using `\\`.')
                     case "poke":
-                        self.command_poke()
+                        self.command_poke(name=(args[1] if len(args)>1 else None))
                         
                     case "stop":
                         self.command_stop()
                         
                     case "system":
                         if(len(args)>1):
-                            self.command_system(args[1])
+                            self.command_system(args[1], name=(args[2] if len(args)>2 else None))
                         else:
                             #self.notify(f'Missing argument. Use `{OPERATOR_STRING}{args[0]} --help` for help with this command.')
-                            self.notify(f'Current system prompt: "{self.system_prompt}"')
-                        if(len(args)>2):
-                            self.notify(f'{len(args)-2} more arguments than expected were supplied. Make sure any quote marks in the supplied system prompt are properly escaped using `\\`.')
+                            for character in self.characters.values():
+                                self.notify(f'Current system prompt for {character.name}: "{character.system_prompt}"')
+                        if(len(args)>3):
+                            self.notify(f'{len(args)-3} more arguments than expected were supplied. Make sure any quote marks in the supplied system prompt are properly escaped using `\\`.')
 
                     case "pause":
                         self.command_pause()
@@ -254,15 +358,26 @@ class Controller():
                     case _:
                         self.notify(f'Unrecognised command `{args[0]}`')
 
-    def command_poke(self) -> None:
-        if(not self._paused):
-            self._poked = True
+    def command_poke(self, name: str|None=None) -> None:
+        if(self._paused):
+            return
+        if(name == None):
+            for character in self.characters.values():
+                character.poked = True
+        elif(name in self.characters):
+            self.characters[name].poked = True
+        else:
+            self.notify(f'The bot is not playing a character named "{name}".')
 
     def command_stop(self) -> None:
         self._stopped = True
 
     def command_pause(self) -> None:
         self._paused = True
+        # Replies that are already pending or being generated would otherwise still be posted
+        for character in self.characters.values():
+            self._cancel_reply(character)
+            character.debounce.reset()
         self.notify('Paused')
  
     def command_resume(self) -> None:
@@ -270,69 +385,246 @@ class Controller():
         self.notify('Resumed')
 
     def command_character(self, name: str) -> None:
-        if(self.r20.controls_character(name)):    
-            self.character = name
-            settings = Controller._get_settings_from_file()
-            try:
-                self.system_prompt = self._get_system_prompt(character=self.character, settings=settings)
-            except:
-                self.notify(f'Failed to load system prompt from settings.yaml. Set it with the `{OPERATOR_STRING}system` command.')
+        if(self.r20.controls_character(name)):
+            for character in self.characters.values():
+                self._cancel_reply(character)
+            self.characters = {name : self._create_character(name)}
         else:
             self.notify(f'This account does not control a character named "{name}".')
 
-    def command_system(self, text: str) -> None:
+    def command_add(self, name: str) -> None:
+        if(name in self.characters):
+            self.notify(f'The bot is already playing {name}.')
+        elif(self.r20.controls_character(name)):
+            self.characters[name] = self._create_character(name)
+        else:
+            self.notify(f'This account does not control a character named "{name}".')
+
+    def command_remove(self, name: str) -> None:
+        if(name not in self.characters):
+            self.notify(f'The bot is not playing a character named "{name}".')
+        elif(len(self.characters) == 1):
+            self.notify(f'The bot must play at least one character. Use `{OPERATOR_STRING}character` to change character, or `{OPERATOR_STRING}pause` to stop posting.')
+        else:
+            self._cancel_reply(self.characters[name])
+            del self.characters[name]
+
+    def command_system(self, text: str, name: str|None=None) -> None:
         assert isinstance(text, str)
-        self.system_prompt = text
+        if(name == None and len(self.characters) > 1):
+            self.notify(f'The bot is playing more than one character. Say whose system prompt to change, e.g. `{OPERATOR_STRING}system \'[new system prompt]\' \'{next(iter(self.characters))}\'`.')
+        elif(name == None):
+            next(iter(self.characters.values())).system_prompt = text
+        elif(name in self.characters):
+            self.characters[name].system_prompt = text
+        else:
+            self.notify(f'The bot is not playing a character named "{name}".')
+
+    def _create_character(self, name: str) -> BotCharacter:
+        settings = Controller._get_settings_from_file()
+        try:
+            system_prompt = self._get_system_prompt(character=name, settings=settings)
+        except:
+            system_prompt = ''
+            self.notify(f'Failed to load system prompt from settings.yaml. Set it with the `{OPERATOR_STRING}system` command.')
+        return BotCharacter(name=name, system_prompt=system_prompt)
 
     def notify(self, text: str):
         assert self.r20.controls_character(self.interface) # type: ignore
         self.r20.post_with_name(text=text, character=self.interface) # type: ignore
 
 
+    # The character's system prompt, with the summary of older history (if there is one) before it
+    def _get_full_system_prompt(self, character: BotCharacter) -> str:
+        if(self._summary == None or self._summary.get_summary() == ''):
+            return character.system_prompt
+        return f'Summary of the story so far:\n{self._summary.get_summary()}\n\n{character.system_prompt}'
+
+    # Posts (part of) a reply as the character. The first part of a reply may start with the character's name
+    # first and last are whether text is the start and end of the reply, as a streamed reply is posted in pieces.
+    # Only the reply's own opening and closing quotes are removed, not those of quotes that start or end a piece
+    def _post_reply(self, character: BotCharacter, text: str, first: bool, last: bool) -> None:
+        text = text.strip()
+        if(first):
+            text = text.removeprefix(f'{character.name}: ').strip().lstrip('"')
+        if(last):
+            text = text.rstrip('"')
+        text = text.strip()
+        if(text != ''):
+            # Posting uses the chat input, so the typing indicator is stopped first. _update_typing starts it again if it's still needed
+            self._stop_typing()
+            self.r20.post_with_name(text=f'"{text}"', character=character.name)
+
+    def _record_usage(self, character: BotCharacter, usage: dict, prompt_estimate: int, estimated: bool) -> None:
+        tokenage = usage['total_tokens']
+        self._tokens_used += tokenage
+        self._usage.record(gameID=self._gameID, character=character.name, prompt_tokens=usage['prompt_tokens'], completion_tokens=usage['completion_tokens'])
+        game_tokens = self._usage.get_totals(gameID=self._gameID)['total_tokens']
+        print(f'{character.name} - Tokens Used - Last Query: ' + ('~' if estimated else '') + str(tokenage) + ' (prompt estimate: ' + str(prompt_estimate) + ') - Total: ' 
+              + str(self._tokens_used) + ' - Game Total: ' + str(game_tokens))
+
+    # Shows the typing indicator while any replies are being generated, as the character whose reply was started first
+    def _update_typing(self) -> None:
+        replying = [character for character in self.characters.values() if character.reply != None]
+        typing_as = (min(replying, key=lambda character: character.reply.started_at).name if len(replying) > 0 else None) # type: ignore
+        if(typing_as == self._typing_as):
+            return
+        if(typing_as == None):
+            self._stop_typing()
+        else:
+            self.r20.start_typing(as_character=typing_as)
+            self._typing_as = typing_as
+
+    def _stop_typing(self) -> None:
+        self.r20.stop_typing()
+        self._typing_as = None
+
+    # Starts generating the character's reply to the chat as it is now, unless it's over the rate limit.
+    # Requests are made asynchronously, so every character's reply can be generated at once.
+    # Returns False if the reply is being queued until it's within the rate limit, in which case this should be called again later. Never waits
+    def _start_reply(self, character: BotCharacter) -> bool:
+        if(self._retriever != None):
+            history = self._retriever.get_context(token_limit=NON_SYSTEM_TOKEN_LIMIT)
+        else:
+            history = self._history_view.get_token_messages(token_limit=NON_SYSTEM_TOKEN_LIMIT)
+        system_prompt = self._get_full_system_prompt(character)
+        prompt_tokens = self.gen.count_prompt_tokens(history=history, system_prompt=system_prompt, as_character=character.name)
+        reserved_tokens = prompt_tokens + EXPECTED_COMPLETION_TOKENS
+        if(not self._rate_limiter.acquire(tokens=reserved_tokens, wait=False)):
+            if(self._rate_limit_policy == RATE_LIMIT_POLICY_DROP):
+                print(f'Rate limit reached, skipping reply for {character.name}')
+                return True
+            if(not character.rate_limited):
+                print(f'Rate limit reached, queueing reply for {character.name}')
+                character.rate_limited = True
+            return False
+        character.rate_limited = False
+        if(self.stream_responses):
+            chunks = Queue()
+            future = self.gen.submit_stream_response(as_character=character.name, history=history, system_prompt=system_prompt, chunks=chunks, model=self.model)
+        else:
+            chunks = None
+            future = self.gen.submit_response(as_character=character.name, history=history, system_prompt=system_prompt, model=self.model)
+        character.reply = PendingReply(future=future, chunks=chunks, prompt_tokens=prompt_tokens, reserved_tokens=reserved_tokens)
+        return True
+
+    # Usage the API reported at the end of the stream. If it hasn't (e.g. the reply was cut short), it's counted locally from the text received so far
+    def _get_streamed_usage(self, reply: PendingReply) -> dict:
+        if(reply.usage != None):
+            return reply.usage
+        completion_tokens = self.gen.count_tokens(''.join(reply.text))
+        return {'prompt_tokens': reply.prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': reply.prompt_tokens + completion_tokens}
+
+    # Cancels the character's reply without posting it. Whatever of it was generated before it was cancelled is still counted
+    def _cancel_reply(self, character: BotCharacter) -> None:
+        reply = character.reply
+        if(reply == None):
+            return
+        reply.cancel()
+        if(reply.is_streamed()):
+            try:
+                reply.take_chunks()
+            except APIError:
+                pass
+            usage = self._get_streamed_usage(reply)
+            self._rate_limiter.settle(reserved=reply.reserved_tokens, used=usage['total_tokens'])
+            if(len(reply.text) > 0):
+                self._record_usage(character, usage, prompt_estimate=reply.prompt_tokens, estimated=(reply.usage == None))
+        elif(reply.future.done() and not reply.future.cancelled() and reply.future.exception() == None):
+            # It had already been generated (and paid for)
+            usage = reply.future.result()['usage']
+            self._rate_limiter.settle(reserved=reply.reserved_tokens, used=usage['total_tokens'])
+            self._record_usage(character, usage, prompt_estimate=reply.prompt_tokens, estimated=False)
+        else:
+            # Only the prompt's tokens are counted against the rate limit, as the reply was (probably) cut short
+            self._rate_limiter.settle(reserved=reply.reserved_tokens, used=reply.prompt_tokens)
+        character.reply = None
+        if(self._posting_character is character):
+            self._posting_character = None
+
+    # Posts whatever of the character's reply is ready, without waiting. Streamed replies are posted a piece at a time as they arrive
+    def _advance_reply(self, character: BotCharacter) -> None:
+        reply = character.reply
+        assert reply != None
+        if(self._posting_character != None and self._posting_character is not character):
+            return
+        try:
+            if(reply.is_streamed()):
+                for text in reply.take_chunks():
+                    for piece in reply.chunker.feed(text): # type: ignore
+                        self._posting_character = character
+                        self._post_reply(character, piece, first=(not reply.posted), last=False)
+                        reply.posted = True
+                if(not reply.finished):
+                    return
+                self._post_reply(character, reply.chunker.flush(), first=(not reply.posted), last=True) # type: ignore
+                usage = self._get_streamed_usage(reply)
+                self._rate_limiter.settle(reserved=reply.reserved_tokens, used=usage['total_tokens'])
+                self._record_usage(character, usage, prompt_estimate=reply.prompt_tokens, estimated=(reply.usage == None))
+            else:
+                if(not reply.future.done()):
+                    return
+                response = reply.future.result()
+                self._rate_limiter.settle(reserved=reply.reserved_tokens, used=response['usage']['total_tokens'])
+                self._record_usage(character, response['usage'], prompt_estimate=reply.prompt_tokens, estimated=False)
+                self._post_reply(character, response['choices'][0]['message']['content'], first=True, last=True)
+        except APIError as error:
+            # Only the prompt, and any of the reply that was received, count against the rate limit
+            used_tokens = (self._get_streamed_usage(reply)['total_tokens'] if reply.is_streamed() else reply.prompt_tokens)
+            self._rate_limiter.settle(reserved=reply.reserved_tokens, used=used_tokens)
+            if(not error.transient):
+                print('API error occurred')
+                raise error
+            # Retries have already been made, so give up on this reply and carry on. The bot will respond again to the next message
+            print(f'API error occurred, skipping reply for {character.name}: {error}')
+        character.reply = None
+        character.reply_restarts = 0
+        if(self._posting_character is character):
+            self._posting_character = None
+        if(self._summary != None):
+            self._summary.update(token_limit=NON_SYSTEM_TOKEN_LIMIT)
+
     def backend(self):
-        stop_idling_event = threading.Event()
         print('Ready')
         self.notify('Ready')
-        while True:
-            new_msgs = self._update_messages()
-            if(len(new_msgs) > 0 or self._poked):
-                # There are new messages
+        try:
+            while True:
+                new_msgs = self._update_messages()
                 if(len(new_msgs) > 0):
                     self.exec_commands(new_msgs)
 
                 if(self._stopped):
                     return 
 
-                if(self._should_respond(new_msgs)):
-                    # Conditions met for new query
-                    history = self.msg_log.get_token_messages(counter=__class__._counter, token_limit=NON_SYSTEM_TOKEN_LIMIT, \
-                                                              character_whitelist=(self.whitelist if self.use_whitelist else None), \
-                                                                character_blacklist=(self.blacklist if self.use_blacklist else None))
-                    try:
-                        stop_idling_event.clear()
-                        idler = threading.Thread(name='idler', daemon=True, target=self.r20.idle, kwargs={'as_character' : self.character, 'stop_event' : stop_idling_event})
-                        idler.start()
-                        response = self.gen.get_response(as_character=self.character, history=history, system_prompt=self.system_prompt, model=self.model)
-
-                        tokenage = response["usage"]["total_tokens"] # type: ignore
-                        self._tokens_used += tokenage
-                        print('Tokens Used - Last Query: ' + str(tokenage) + ' - Total: ' + str(self._tokens_used))
-                        text = response['choices'][0]['message']['content'].strip().removeprefix(f'{self.character}: ').strip('"') # type: ignore
-
-                        stop_idling_event.set()
-                        while(idler.is_alive()):
-                            pass
-
-                        self.r20.post_with_name(text=f'"{text}"', character=self.character)
-                    except APIError as error:
-                        print('API error occurred')
-                        raise error
-                    self._poked = False
-            else:
-                sleep(MESSAGE_POLLING_SLEEP_INTERVAL)
-
-
-
-                    
-
-
+                for character in self.characters.values():
+                    # Messages from anyone but the bot that would be in the prompt make a reply that hasn't been posted yet out of date.
+                    # The bot's other characters don't count, as with _should_respond, so their replies don't keep restarting each other
+                    if(any(self._history_view.matches(msg) and msg.get_character() not in self.characters for msg in new_msgs)):
+                        character.debounce.activity()
+                        if(character.reply != None and not character.reply.posted and character.reply_restarts < MAX_REPLY_RESTARTS):
+                            print(f'New messages arrived, restarting reply for {character.name}')
+                            self._cancel_reply(character)
+                            character.reply_restarts += 1
+                            character.debounce.trigger()
+
+                    if(self._should_respond(character, new_msgs)):
+                        character.debounce.trigger()
+                        character.poked = False
+
+                    # Bursts of messages are answered with one reply, once the chat goes quiet
+                    if(character.reply == None and not self._paused and character.debounce.is_due()):
+                        if(self._start_reply(character)):
+                            character.debounce.reset()
+
+                # Replies are posted one at a time, earliest started first
+                replying = [character for character in self.characters.values() if character.reply != None]
+                for character in sorted(replying, key=lambda character: character.reply.started_at): # type: ignore
+                    self._advance_reply(character)
+                self._update_typing()
+
+                if(len(new_msgs) == 0):
+                    sleep(MESSAGE_POLLING_SLEEP_INTERVAL)
+        finally:
+            for character in self.characters.values():
+                self._cancel_reply(character)
+            self._stop_typing()
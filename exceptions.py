@@ -1,9 +1,12 @@
 class APIError(Exception):
-    def __init__(self):
+    # transient: whether the request might succeed if tried again later (e.g. it timed out, or was rate limited)
+    def __init__(self, message: str='', transient: bool=False):
         super().__init__(self)
+        self.message = message
+        self.transient = transient
 
     def __str__(self):
-        return "APIError"
+        return "APIError" + (f': {self.message}' if self.message != '' else '')
     
 class FileFormatError(Exception):
     def __init__(self):
@@ -1,14 +1,111 @@
-import openai
-import os
-import math
+import re
+from concurrent.futures import Future
+from queue import Queue
 
 from messages import *
 from messages import Message
-from exceptions import APIError
+from llm_client import LLMClient, get_default_client
+from tokenizer import TokenCounter, HeuristicTokenCounter
 
-class Generator():
+# Renders chat history into the prompt text sent to the model.
+# Between consecutive prompts the history window usually only slides along by a few messages, so each message's rendered text 
+# is cached by message id (along with whether it continues from or into a neighbouring message by the same character),
+# and only messages that are new to the window are rendered. The cache only keeps the messages used in the last prompt.
+class PromptBuilder():
     def __init__(self):
-        openai.api_key = os.getenv("OPENAI_API_KEY")
+        # (id, continued, continues) -> (content, character, rendered text)
+        self._fragments = dict()
+
+    def build(self, messages: list[Message], for_character: str|None) -> str:
+        previous_fragments = self._fragments
+        fragments = dict()
+        parts = []
+        # continuations[i] is True iff messages[i+1] continues messages[i]
+        continuations = [Generator._is_continuation(messages[i], messages[i+1]) for i in range(len(messages)-1)] + [False]
+        continued = False
+        for index, msg in enumerate(messages):
+            continues = continuations[index]
+            key = (msg.get_id(), continued, continues)
+            cached = previous_fragments.get(key)
+            if(cached != None and cached[0] is msg.get_content() and cached[1] is msg.get_character()):
+                fragment = cached[2]
+            else:
+                fragment = __class__._render(msg, continued, continues)
+            if(msg.get_id() != None):
+                fragments[key] = (msg.get_content(), msg.get_character(), fragment)
+            parts.append(fragment)
+            continued = continues
+        if(for_character != None):
+            parts.append(f'{for_character}: ')
+        self._fragments = fragments
+        return ''.join(parts)
+
+    @staticmethod
+    def _render(msg: Message, continued: bool, continues: bool) -> str:
+        if(msg.has_tag(MessageTag.CHARACTER)):
+            output = ''
+            if(not continued):
+                output += msg.get_character() + ': \"' # type: ignore
+            output += msg.get_content().removeprefix('"').removesuffix('"')
+
+            if(continues):
+                output += '\n'
+            else:
+                output += '"\n\n'
+            return output
+        else:
+            return msg.get_content() + "\n\n"
+
+# A streamed reply is posted in pieces at least this long, cut at the end of a sentence (or sooner, at the end of a paragraph)
+STREAM_POST_MIN_LENGTH = 200
+SENTENCE_END_PATTERN = re.compile(r'[.!?]+["\')\]]*\s+')
+
+# Cuts streamed text into pieces that can be posted before the rest of the reply has arrived
+class SentenceChunker():
+    def __init__(self, min_length: int=STREAM_POST_MIN_LENGTH):
+        self._min_length = min_length
+        self._buffer = ''
+
+    # Returns the pieces that are complete now that text has been added.
+    # A piece is only returned once some text after it has arrived, so the end of the reply is always returned by flush
+    def feed(self, text: str) -> list[str]:
+        self._buffer += text
+        pieces = []
+        cut = self._find_cut()
+        while(cut != None and self._buffer[cut:].strip() != ''):
+            pieces.append(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+            cut = self._find_cut()
+        return pieces
+
+    # Returns whatever is left once the stream has ended
+    def flush(self) -> str:
+        rest = self._buffer
+        self._buffer = ''
+        return rest
+
+    def _find_cut(self) -> int|None:
+        paragraph_end = self._buffer.find('\n\n')
+        if(paragraph_end != -1 and self._buffer[:paragraph_end].strip() != ''):
+            return paragraph_end + 2
+        if(len(self._buffer) < self._min_length):
+            return None
+        sentence_end = SENTENCE_END_PATTERN.search(self._buffer, self._min_length - 1)
+        return (sentence_end.end() if sentence_end != None else None)
+
+SUMMARY_SYSTEM_PROMPT = ('You keep a running summary of a TTRPG campaign, so that it can be continued by someone who has forgotten the earlier sessions. '
+                         'Update the summary with the new events. Keep the people, places, items, promises and unresolved plot threads that might come up again, '
+                         'and drop details that no longer matter. Reply with only the updated summary, in at most {word_limit} words.')
+SUMMARY_WORD_LIMIT = 250
+
+class Generator():
+    def __init__(self, counter: TokenCounter|None=None, client: LLMClient|None=None):
+        self.client = (client if client != None else get_default_client())
+        self.counter = (counter if counter != None else HeuristicTokenCounter())
+        # One per Generator (so per game), as its cache only holds the last prompt built with it
+        self._prompt_builder = PromptBuilder()
+        # Kept separate from _prompt_builder, whose cache is for the reply prompts' sliding window
+        self._summary_builder = PromptBuilder()
         
     @staticmethod
     def _is_continuation(msg1: Message, msg2: Message):
@@ -17,46 +114,45 @@ class Generator():
             return True
         return False
 
-    @staticmethod
-    def _format_messages(messages: list[Message], for_character: str|None) -> str:
-        output = ""
-        for index, msg in enumerate(messages):
-            if(msg.has_tag(MessageTag.CHARACTER)):
-                continued = (__class__._is_continuation(messages[index-1], msg) if index != 0 else False)
-                continues = (__class__._is_continuation(msg, messages[index+1]) if index != len(messages)-1 else False)
-
-                if(not continued):
-                    output += msg.get_character() + ': \"' # type: ignore
-                output += msg.get_content().removeprefix('"').removesuffix('"')
-
-                if(continues):
-                    output += '\n'
-                else:
-                    output += '"\n\n'
-            else:
-                output += msg.get_content() + "\n\n"
-        if(for_character != None):
-            output += f'{for_character}: '
-        return output
-            
+    def _format_messages(self, messages: list[Message], for_character: str|None) -> str:
+        return self._prompt_builder.build(messages=messages, for_character=for_character)
+
+    def _build_request(self, history: list[Message], system_prompt, as_character: str) -> list[dict]:
+        input = self._format_messages(messages=history, for_character=as_character)
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": input},
+        ]
+
     # Filtering out non-narration/non-character messages should be done prior to calling this method
-    @staticmethod
-    def get_response(history: list[Message], system_prompt, as_character: str, model='gpt-4'):
-        input = __class__._format_messages(messages=history, for_character=as_character)
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        try:
-            response = openai.ChatCompletion.create(
-                model=model.lower(),
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": input},
-                ]
-            )
-            return response
-        except Exception as error:
-            raise APIError
+    # Raises APIError if the request fails
+    def get_response(self, history: list[Message], system_prompt, as_character: str, model='gpt-4') -> dict:
+        messages = self._build_request(history=history, system_prompt=system_prompt, as_character=as_character)
+        return self.client.chat_completion(model=model.lower(), messages=messages)
 
-    @staticmethod
-    def count_tokens(char_count: int) -> int:
-        #This is only an approximation
-        return math.ceil(0.25*(char_count))
\ No newline at end of file
+    # Like get_response, but returns a Future for the response, so the request can be cancelled
+    def submit_response(self, history: list[Message], system_prompt, as_character: str, model='gpt-4') -> Future:
+        messages = self._build_request(history=history, system_prompt=system_prompt, as_character=as_character)
+        return self.client.submit_chat_completion(model=model.lower(), messages=messages)
+
+    # Like submit_response, but streams the reply: its text is put on chunks as it's generated, followed by its usage 
+    # (see LLMClient.submit_stream_chat_completion). If the API doesn't report usage, use count_tokens on the text to estimate it
+    def submit_stream_response(self, history: list[Message], system_prompt, as_character: str, chunks: Queue, model='gpt-4') -> Future:
+        messages = self._build_request(history=history, system_prompt=system_prompt, as_character=as_character)
+        return self.client.submit_stream_chat_completion(model=model.lower(), messages=messages, chunks=chunks)
+
+    # Returns a response whose text is summary updated with the events in messages. Raises APIError if the request fails
+    def get_summary(self, summary: str, messages: list[Message], model='gpt-4') -> dict:
+        events = self._summary_builder.build(messages=messages, for_character=None)
+        request = [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT.format(word_limit=SUMMARY_WORD_LIMIT)},
+            {"role": "user", "content": f'Summary so far:\n{summary if summary != "" else "(nothing yet)"}\n\nNew events:\n{events}'},
+        ]
+        return self.client.chat_completion(model=model.lower(), messages=request)
+
+    def count_tokens(self, text: str) -> int:
+        return self.counter.count(text)
+
+    # Number of tokens in the prompt get_response() would send (not counting the few tokens of per-message overhead the API adds)
+    def count_prompt_tokens(self, history: list[Message], system_prompt: str, as_character: str) -> int:
+        return self.count_tokens(system_prompt) + self.count_tokens(self._format_messages(messages=history, for_character=as_character))
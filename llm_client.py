@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import random
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from queue import Queue
+
+import httpx
+
+from exceptions import APIError
+
+DEFAULT_API_BASE = 'https://api.openai.com/v1'
+# Seconds a request may take in total, including retries. For streamed requests, this only covers the wait for the response to start
+REQUEST_DEADLINE = 120
+CONNECT_TIMEOUT = 10
+# Longest wait, in seconds, between chunks of a streamed response
+STREAM_READ_TIMEOUT = 30
+MAX_ATTEMPTS = 5
+# Retry delays grow exponentially from BACKOFF_BASE seconds up to BACKOFF_CAP seconds, and are randomised so that clients don't retry in step
+BACKOFF_BASE = 1
+BACKOFF_CAP = 30
+# Responses with these status codes are worth retrying
+TRANSIENT_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+MAX_CONNECTIONS = 10
+
+# Marks the end of a streamed response
+END_OF_STREAM = object()
+
+# Client for the chat completions API. Requests are run concurrently on an asyncio event loop on a thread owned by the client,
+# sharing a pool of persistent connections, so many threads (e.g. one per hosted game) can share one client.
+# Failed requests are retried with backoff while that could help. Errors are raised as APIError, with transient=True 
+# if the request might succeed if tried again later.
+class LLMClient():
+    def __init__(self, api_key: str|None=None, api_base: str|None=None):
+        self._api_key = (api_key if api_key != None else os.getenv("OPENAI_API_KEY"))
+        self._api_base = (api_base if api_base != None else os.getenv("OPENAI_API_BASE", DEFAULT_API_BASE)).rstrip('/')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(name='llm-client', daemon=True, target=self._loop.run_forever)
+        self._thread.start()
+        self._client = self._submit(self._create_client()).result()
+
+    async def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(base_url=self._api_base,
+                                 headers={'Authorization': f'Bearer {self._api_key}'},
+                                 limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS))
+
+    def _submit(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    # Returns a Future for the parsed JSON response
+    def submit_chat_completion(self, model: str, messages: list[dict]) -> Future:
+        return self._submit(self._chat_completion({'model': model, 'messages': messages}))
+
+    def chat_completion(self, model: str, messages: list[dict]) -> dict:
+        return self.submit_chat_completion(model=model, messages=messages).result()
+
+    # Starts a streamed request. The reply's text is put on chunks as it's generated, followed by the request's usage (a dict, if the API reports it)
+    # and END_OF_STREAM, or by an APIError if the request fails. Requests are only retried until the response starts, as by then the caller 
+    # may have used some of it. Cancelling the returned Future cancels the request
+    def submit_stream_chat_completion(self, model: str, messages: list[dict], chunks: Queue) -> Future:
+        payload = {'model': model, 'messages': messages, 'stream': True, 'stream_options': {'include_usage': True}}
+        return self._submit(self._stream_chat_completion(payload, chunks))
+
+    def close(self) -> None:
+        self._submit(self._client.aclose()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _chat_completion(self, payload: dict) -> dict:
+        deadline = self._loop.time() + REQUEST_DEADLINE
+        attempt = 0
+        while True:
+            remaining = deadline - self._loop.time()
+            retry_after = None
+            try:
+                response = await asyncio.wait_for(
+                    self._client.post('/chat/completions', json=payload, timeout=httpx.Timeout(remaining, connect=CONNECT_TIMEOUT)),
+                    timeout=remaining)
+                if(response.status_code == 200):
+                    return response.json()
+                error = __class__._error_from_response(response, response.text)
+                retry_after = __class__._parse_retry_after(response.headers.get('retry-after'))
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                error = APIError(message=repr(e), transient=True)
+            except json.JSONDecodeError as e:
+                error = APIError(message=f'Invalid response: {e}', transient=True)
+            attempt += 1
+            await self._wait_to_retry(error, attempt, retry_after, deadline)
+
+    async def _stream_chat_completion(self, payload: dict, chunks: Queue) -> None:
+        deadline = self._loop.time() + REQUEST_DEADLINE
+        attempt = 0
+        try:
+            while True:
+                remaining = deadline - self._loop.time()
+                retry_after = None
+                try:
+                    request = self._client.build_request('POST', '/chat/completions', json=payload, 
+                                                         timeout=httpx.Timeout(STREAM_READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+                    response = await asyncio.wait_for(self._client.send(request, stream=True), timeout=remaining)
+                    if(response.status_code == 200):
+                        break
+                    body = (await response.aread()).decode(errors='replace')
+                    await response.aclose()
+                    error = __class__._error_from_response(response, body)
+                    retry_after = __class__._parse_retry_after(response.headers.get('retry-after'))
+                except (httpx.TransportError, asyncio.TimeoutError) as e:
+                    error = APIError(message=repr(e), transient=True)
+                attempt += 1
+                await self._wait_to_retry(error, attempt, retry_after, deadline)
+
+            try:
+                # Server-sent events, one JSON chunk per 'data:' line
+                async for line in response.aiter_lines():
+                    if(not line.startswith('data:')):
+                        continue
+                    data = line.removeprefix('data:').strip()
+                    if(data == '[DONE]'):
+                        break
+                    chunk = json.loads(data)
+                    choices = chunk.get('choices')
+                    text = (choices[0].get('delta', {}).get('content') if choices else None)
+                    if(text):
+                        chunks.put(text)
+                    # Only the last chunk, which has no choices, has usage
+                    if(chunk.get('usage')):
+                        chunks.put(chunk['usage'])
+            except (httpx.TransportError, json.JSONDecodeError) as e:
+                raise APIError(message=f'Stream interrupted: {e!r}', transient=True)
+            finally:
+                await response.aclose()
+            chunks.put(END_OF_STREAM)
+        except APIError as error:
+            chunks.put(error)
+        except Exception as e:
+            chunks.put(APIError(message=repr(e)))
+
+    # Sleeps before the next attempt, or raises error if there's no attempt or time left
+    async def _wait_to_retry(self, error: APIError, attempt: int, retry_after: float|None, deadline: float) -> None:
+        if(not error.transient or attempt >= MAX_ATTEMPTS):
+            raise error
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**(attempt-1)))
+        if(retry_after != None):
+            delay = max(delay, retry_after)
+        if(self._loop.time() + delay >= deadline):
+            raise error
+        print(f'{error}. Retrying in {delay:.1f}s (attempt {attempt+1} of {MAX_ATTEMPTS})')
+        await asyncio.sleep(delay)
+
+    @staticmethod
+    def _error_from_response(response: httpx.Response, body: str) -> APIError:
+        return APIError(message=f'HTTP {response.status_code}: {body[:200]}', transient=(response.status_code in TRANSIENT_STATUS_CODES))
+
+    # Retry-After is either a number of seconds or an HTTP date
+    @staticmethod
+    def _parse_retry_after(value: str|None) -> float|None:
+        if(value == None):
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+# The client shared by every Generator that isn't given one, created on first use (so after any .env file has been loaded)
+def get_default_client() -> LLMClient:
+    global _default_client
+    with _default_client_lock:
+        if(_default_client == None):
+            _default_client = LLMClient()
+        return _default_client
@@ -5,6 +5,7 @@ from controller import Controller
 from globals import *
 
 import argparse
+import threading
 from dotenv import load_dotenv, find_dotenv
 
 parser = argparse.ArgumentParser(
@@ -18,6 +19,8 @@ parser.add_argument('-u', '--username', help=f"Roll20 email. Alternatively, put
 parser.add_argument('-p', '--password', help=f"Roll20 password. Alternatively, put this in a environment variable ${ENV_R20_PASSWORD}")
 parser.add_argument('-e', '--env', action='store_true', help="enable the use of a .env file for initialising environment variables")
 parser.add_argument('-x', '--headless', action='store_true', help='Start the webdriver in headless mode')
+parser.add_argument('-m', '--host', action='store_true', help='Play in every game listed under `hosted_games` in settings.yaml, using one browser and one login')
+parser.add_argument('-o', '--chat_only', action='store_true', help="Don't load images or media or render the tabletop. Greatly reduces the browser's memory and CPU usage")
 
 def main():
     args = parser.parse_args()
@@ -34,13 +37,18 @@ def main():
     if(args.headless):
         driver_args.append('--headless')
 
-    r20 = Roll20(driver_args=driver_args)
+    r20 = Roll20(driver_args=driver_args, chat_only=args.chat_only)
     os.environ[ENV_R20_EMAIL] = (args.username if args.username != None else os.environ[ENV_R20_EMAIL])
     os.environ[ENV_R20_PASSWORD] = (args.password if args.password != None else os.environ[ENV_R20_PASSWORD])
     os.environ[ENV_API_KEY] = (args.apikey if args.apikey != None else os.environ[ENV_API_KEY])
     os.environ[ENV_CF_CLEARANCE] = (args.cf_clearance if args.cf_clearance != None else os.environ[ENV_CF_CLEARANCE])
     r20.login(use_env=True)
 
+    if(args.host):
+        host(r20)
+        r20.close()
+        return
+
     if(args.gameID == None):
         gameID = input('Provide the game ID of the game you want to join: ')
     else:
@@ -50,7 +58,34 @@ def main():
     print('Initialising...')
     controller = Controller(r20=r20, gameID=gameID) # type: ignore
     controller.backend()
-    del r20
+    r20.close()
+
+# Joins every game listed under `hosted_games` in settings.yaml, each in its own tab of r20's browser, and runs a Controller for each.
+# Precondition: r20 must be logged in
+def host(r20: Roll20):
+    gameIDs = Controller._get_settings_from_file().get('hosted_games')
+    if(gameIDs == None or len(gameIDs) == 0):
+        print('settings.yaml lists no games under `hosted_games`')
+        return
+
+    tabs = []
+    controllers = []
+    for gameID in gameIDs:
+        tab = (r20 if len(tabs) == 0 else Roll20(share_session_with=r20))
+        tabs.append(tab)
+        tab.join_game(gameID=gameID)
+        print(f'Initialising game {gameID}...')
+        controllers.append(Controller(r20=tab, gameID=gameID)) # type: ignore
+
+    # Controllers only block on the browser while waiting for their turn on its WebDriver thread, so they can all run at once
+    threads = [threading.Thread(name=f'controller-{gameID}', target=controller.backend) for gameID, controller in zip(gameIDs, controllers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for tab in tabs[1:]:
+        tab.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,106 @@
+import sqlite3
+from typing import Iterator
+
+from messages import Message, MessageTag
+
+DEFAULT_CACHE_DIRECTORY = 'cache'
+STORE_BATCH_SIZE = 500
+# Only this many of the rarest terms of a search are searched for. Common terms say little about which messages match best, 
+# but each one matches a large part of the store, which all has to be scored
+SEARCH_TERM_LIMIT = 16
+
+# On-disk store of a game's whole message log, so that the chat archive doesn't need to be scraped from scratch every start,
+# and so that a MessageLog only needs to keep its latest messages in memory.
+# Messages are keyed by their position in the log. Every message appended to the log is stored, so the store carries on across restarts.
+# Message contents are also indexed for full-text search (SQLite FTS5), so the index is on disk too rather than in memory
+class MessageStore():
+    def __init__(self, path: str):
+        # The log may be used from a different thread to the one that created it (e.g. in --host mode), though never from two at once
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS messages (position INTEGER PRIMARY KEY, id TEXT, content TEXT, character TEXT, tags INTEGER)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS messages_id ON messages (id)')
+        has_search_index = self._connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_search'").fetchone() != None
+        # Only indexes content, which is read from the messages table rather than stored twice.
+        # Diacritics are kept so that the index's terms are the same as lowercased words
+        self._connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_search USING fts5(content, content='messages', content_rowid='position', "
+                                 "tokenize='unicode61 remove_diacritics 0')")
+        if(not has_search_index):
+            # e.g. a store written before messages were indexed
+            self._connection.execute("INSERT INTO messages_search (messages_search) VALUES ('rebuild')")
+        self._connection.commit()
+        # Number of messages each term is in
+        self._connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.messages_search_terms USING fts5vocab(main, 'messages_search', 'row')")
+
+    def close(self) -> None:
+        self._connection.close()
+
+    # Number of messages stored, which is also the position the next one is stored at
+    def count(self) -> int:
+        row = self._connection.execute('SELECT MAX(position) FROM messages').fetchone()
+        return (row[0] + 1 if row[0] != None else 0)
+
+    # Returns the id of the newest message (see messages.is_newer_id), or None
+    def get_newest_id(self) -> str|None:
+        row = self._connection.execute('SELECT MAX(id) FROM messages').fetchone()
+        return row[0]
+
+    # Stores messages at consecutive positions starting from start_position
+    def append(self, start_position: int, messages: list[Message]) -> None:
+        rows = [(start_position + i, msg.get_id(), msg.get_content(), msg.get_character(), msg.get_tag_mask()) for i, msg in enumerate(messages)]
+        self._connection.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', rows)
+        self._connection.executemany('INSERT INTO messages_search (rowid, content) VALUES (?, ?)', [(row[0], row[2]) for row in rows])
+        self._connection.commit()
+
+    # Returns the position of the first message with the given id, or None
+    def find(self, id: str) -> int|None:
+        row = self._connection.execute('SELECT MIN(position) FROM messages WHERE id = ?', (id,)).fetchone()
+        return row[0]
+
+    # Returns the position of the first message with a newer id than the given one (see messages.is_newer_id), or None
+    def find_newer(self, id: str) -> int|None:
+        row = self._connection.execute('SELECT MIN(position) FROM messages WHERE id > ?', (id,)).fetchone()
+        return row[0]
+
+    def get(self, position: int) -> Message|None:
+        row = self._connection.execute('SELECT content, character, id, tags FROM messages WHERE position = ?', (position,)).fetchone()
+        return (__class__._to_message(row) if row != None else None)
+
+    # Yields the messages at positions start to end-1, in order (or in reverse order if reverse is set).
+    # Messages are read in batches, so only a batch is held in memory at a time
+    def iter_messages(self, start: int, end: int, reverse=False) -> Iterator[Message]:
+        while start < end:
+            if(reverse):
+                rows = self._connection.execute('SELECT content, character, id, tags, position FROM messages WHERE position >= ? AND position < ? ORDER BY position DESC LIMIT ?',
+                                                (start, end, STORE_BATCH_SIZE)).fetchall()
+            else:
+                rows = self._connection.execute('SELECT content, character, id, tags, position FROM messages WHERE position >= ? AND position < ? ORDER BY position LIMIT ?',
+                                                (start, end, STORE_BATCH_SIZE)).fetchall()
+            if(len(rows) == 0):
+                return
+            for row in rows:
+                yield __class__._to_message(row)
+            if(reverse):
+                end = rows[-1][4]
+            else:
+                start = rows[-1][4] + 1
+
+    # Yields (score, position, message) for the messages before position `before` which contain any of terms (lowercase words), best first.
+    # Scores are BM25 (higher is better). Only the SEARCH_TERM_LIMIT rarest terms are used
+    def search(self, terms: list[str], before: int) -> Iterator[tuple[float, int, Message]]:
+        if(len(terms) == 0):
+            return
+        placeholders = ', '.join('?' for term in terms)
+        rows = self._connection.execute(f'SELECT term FROM messages_search_terms WHERE term IN ({placeholders}) ORDER BY doc LIMIT ?', 
+                                        (*terms, SEARCH_TERM_LIMIT)).fetchall()
+        terms = [row[0] for row in rows]
+        if(len(terms) == 0):
+            return
+        query = ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+        # Messages are only read for the matches the caller gets to, rather than joined to every match before sorting
+        cursor = self._connection.execute('SELECT -rank, rowid FROM messages_search WHERE messages_search MATCH ? AND rowid < ? ORDER BY rank', (query, before))
+        for score, position in cursor:
+            yield (score, position, self.get(position))
+
+    @staticmethod
+    def _to_message(row) -> Message:
+        return Message(row[0], row[1], row[2], MessageTag(row[3]))
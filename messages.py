@@ -1,13 +1,17 @@
-from enum import Enum
+from enum import Flag
+from bisect import bisect_left
+from typing import Iterator
+import sys
 
 
-class MessageTag(Enum):
+# Each tag is one bit, so a message's tags can be stored and tested as a single integer
+class MessageTag(Flag):
     CHARACTER = 1
     SYSTEM = 2          
-    HIDDEN = 3
-    DICE = 4
-    EMOTE = 5
-    DESCRIPTION = 6
+    HIDDEN = 4
+    DICE = 8
+    EMOTE = 16
+    DESCRIPTION = 32
 
     # combines a blacklist and a whitelist of MessageTags into just a blacklist
     @classmethod
@@ -19,20 +23,43 @@ class MessageTag(Enum):
             return combined_blacklist.union(blacklist)
         return combined_blacklist
 
+    # returns the integer bitmask of tags, which may be an iterable of MessageTags or a combined MessageTag
+    @classmethod
+    def to_mask(cls, tags) -> int:
+        if(isinstance(tags, MessageTag)):
+            return tags.value
+        mask = 0
+        for tag in tags:
+            mask |= tag.value
+        return mask
+
+    # returns the set of MessageTags in an integer bitmask
+    @classmethod
+    def from_mask(cls, mask: int) -> set:
+        return {tag for tag in MessageTag if tag.value & mask}
+
 SYSTEM_TAGS = {MessageTag.SYSTEM, MessageTag.DICE, MessageTag.HIDDEN}
 
+# Roll20 message ids are Firebase push ids, which sort in the order the messages were posted
+def is_newer_id(id: str|None, than_id: str) -> bool:
+    return id != None and id > than_id
 
+
+# Whole campaign histories are kept in memory, so messages are kept small: no instance __dict__,
+# tags stored as an integer bitmask, and character names interned so each name is only stored once
 class Message():
+    __slots__ = ('_content', '_character', '_id', '_tags')
+
     def __init__(self, content, character, id, tags):
         self._content = content
-        self._character = character
+        self._character = (sys.intern(character) if character != None else None)
         self._id = id
-        self._tags = tags
+        self._tags = MessageTag.to_mask(tags)
 
     # should've used MutableMessage, but i'll just tack this here to allow for fixing orphaned messages when joining them to a messageLog
     def fix_character(self, character: str|None):
         assert(self._character == None)
-        self._character = character
+        self._character = (sys.intern(character) if character != None else None)
 
     def get_content(self) -> str:
         return self._content
@@ -44,29 +71,33 @@ class Message():
         return self._id
 
     def get_tags(self) -> set[MessageTag]:
+        return MessageTag.from_mask(self._tags)
+
+    def get_tag_mask(self) -> int:
         return self._tags
 
     def has_tag(self, tag: MessageTag) -> bool:
-        return tag in self.get_tags()
+        return self._tags & tag.value != 0
 
     def has_any_of_tags(self, tags: set[MessageTag]) -> bool:
-        return not self.get_tags().isdisjoint(tags)
+        return self._tags & MessageTag.to_mask(tags) != 0
 
     def hide(self):
-        if MessageTag.HIDDEN not in self.get_tags():
-            self._tags.append(MessageTag.HIDDEN)
+        self._tags |= MessageTag.HIDDEN.value
 
+    # counter is a tokenizer.TokenCounter
     def count_tokens(self, counter) -> int:
-        #This is only an approximation
-        return counter(len(self.get_content()))
+        return counter.count_message(self)
 
 def filter_tags(messages: list[Message], tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[Message]:
-    ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
-    return [msg for msg in messages if not msg.has_any_of_tags(ignore_tags)]
+    ignore_mask = MessageTag.to_mask(MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist))
+    return [msg for msg in messages if msg.get_tag_mask() & ignore_mask == 0]
 
 class MutableMessage(Message):
+    __slots__ = ()
+
     def set_character(self, character: str|None):
-        self._character = character
+        self._character = (sys.intern(character) if character != None else None)
 
     def set_id(self, id):
         assert(type(id) in (str, None))
@@ -78,18 +109,123 @@ class MutableMessage(Message):
 
     def set_tag(self, tag: MessageTag):
         assert(type(tag) == MessageTag)
-        if tag not in self.get_tags():
-            self._tags.append(tag)
+        self._tags |= tag.value
 
     def set_tags(self, tags: list[MessageTag]):
         for tag in tags:
             self.set_tag(tag)
 
+# A log of messages in the order they were posted.
+# If store (a message_store.MessageStore) is given, the log carries on from the messages already in it, and every message appended is also stored.
+# If hot_window is given too, only about the latest hot_window messages are kept in memory, and older ones are only read from the store. 
+# Every query still covers the whole log.
+# Positions are counted from the start of the whole log, so a message keeps its position when it's dropped from memory.
 class MessageLog():
-    def __init__(self):
+    def __init__(self, hot_window: int|None=None, store=None):
+        assert hot_window == None or store != None
+        # The in-memory messages. self.log[0] is at position self._offset; earlier messages are only in self._store
         self.log = list()
+        self._offset = 0
+        self._hot_window = hot_window
+        self._store = store
+        # message id -> position, for in-memory messages
+        self._index = dict()
+        # MessageViews kept up to date as messages are appended
+        self._views = list()
+        # filter key -> MessageView used by get_token_messages
+        self._token_views = dict()
+        # character of the last message that speakerless character messages inherit from (see _get_last_character)
+        self._last_character = None
+        if(store != None):
+            end = store.count()
+            self._offset = (max(end - hot_window, 0) if hot_window != None else 0)
+            self.log = list(store.iter_messages(self._offset, end))
+            self._reindex()
+
+    # Number of messages in the whole log
+    def __len__(self) -> int:
+        return self._offset + len(self.log)
+
+    def _index_message(self, message: Message, position: int) -> None:
+        if(message.get_id() != None):
+            # Like a linear scan, prefer the first message with a given id
+            self._index.setdefault(message.get_id(), position)
+
+    # Rebuilds the id index and the last character after the in-memory messages are replaced, or inserted anywhere but the end of the log
+    def _reindex(self) -> None:
+        self._index = dict()
+        self._last_character = None
+        for position, message in enumerate(self.log, start=self._offset):
+            self._index_message(message, position)
+            if(message.get_character() != None and message.get_tag_mask() & self._SPEAKER_IGNORE_MASK == 0):
+                self._last_character = message.get_character()
+        for view in self._views:
+            view._rebuild()
+
+    # Drops messages beyond the hot window from memory, leaving them in the store. Messages are dropped in batches of a quarter of the window, 
+    # so the in-memory list isn't shifted on every append
+    def _spill(self) -> None:
+        if(self._hot_window == None or len(self.log) <= self._hot_window + self._hot_window//4):
+            return
+        count = len(self.log) - self._hot_window
+        spilled = self.log[:count]
+        for position, message in enumerate(spilled, start=self._offset):
+            if(message.get_id() != None and self._index.get(message.get_id()) == position):
+                del self._index[message.get_id()]
+        del self.log[:count]
+        self._offset += count
+        for view in self._views:
+            view._trim(self._offset)
+
+    def _get_message(self, position: int) -> Message|None:
+        if(position >= self._offset):
+            return self.log[position - self._offset]
+        return self._store.get(position) # type: ignore
+
+    def _find(self, id: str) -> int|None:
+        position = self._index.get(id)
+        if(position == None and self._offset > 0):
+            position = self._store.find(id) # type: ignore
+        return position
+
+    # Position just after the message with the given id. If no message has the id, the position of the first message with a newer id,
+    # or the end of the log if there isn't one
+    def _find_after(self, id: str) -> int:
+        position = self._find(id)
+        if(position != None):
+            return position + 1
+        if(self._store != None):
+            position = self._store.find_newer(id)
+        else:
+            position = next((position for position, message in enumerate(self.log) if is_newer_id(message.get_id(), id)), None)
+        return (position if position != None else len(self))
+
+    # Yields every message from position `start` onwards, from the store and then from memory
+    def _iter_messages(self, start=0) -> Iterator[Message]:
+        if(start < self._offset):
+            yield from self._store.iter_messages(start, self._offset) # type: ignore
+        yield from self.log[max(start - self._offset, 0):]
+
+    # Yields (score, position, message) for the messages before position `before` which contain any of terms, best match first.
+    # The search index is kept in the store, so this needs a log with one
+    def _search(self, terms: list[str], before: int) -> Iterator[tuple[float, int, Message]]:
+        if(self._store == None):
+            raise ValueError('Cannot search a MessageLog without a store')
+        return self._store.search(terms, before=before)
+
+    # Yields every message before position `end` (or in the whole log), latest first
+    def _iter_messages_reversed(self, end: int|None=None) -> Iterator[Message]:
+        end = (end if end != None else self._offset + len(self.log))
+        yield from reversed(self.log[:max(end - self._offset, 0)])
+        if(self._offset > 0):
+            yield from self._store.iter_messages(0, min(end, self._offset), reverse=True) # type: ignore
+
+    # Only messages with no tags other than CHARACTER are used to work out who posted a speakerless character message
+    _SPEAKER_IGNORE_MASK = MessageTag.to_mask(MessageTag.to_blacklist(blacklist=None, whitelist=[MessageTag.CHARACTER]))
 
     def _get_last_character(self, index=None) -> str|None:
+        if(index == None):
+            return self._last_character
         messages = self.get_log(tag_whitelist=[MessageTag.CHARACTER])
         # Latest index, or specified index if it exists
         index = (index if index != None and index >= 0 and index <= len(messages)-1 else len(messages)-1)
@@ -98,81 +234,254 @@ class MessageLog():
             character = messages[index].get_character()
             index -= 1 
         return character
-        
-
 
     def append_message(self, message: Message) -> Message:
-        if(message.get_character() == None and message.has_tag(MessageTag.CHARACTER)):
-            last = self._get_last_character()
-            if(last == None):
-                print('Warning: Message is tagged as character message, but has no character associated with it.')
-            message.fix_character(last)
-        self.log.append(message)
-        return message
+        return self.append_messages([message])[0]
     
+    # Prepending isn't supported when the log has a store
     def prepend_message(self, message: Message) -> None:
-        self.log.insert(0, message)
+        self.prepend_messages([message])
 
     def append_messages(self, messages: list[Message]) -> list[Message]:
-        for msg in messages:
-            self.append_message(msg)
-        # messages *should* be passed by reference, so any calls of Message.fix_character from 
-        # Message.append_message should be refelected in the returned list
+        # The last character is tracked as messages are appended, so this is linear in len(messages)
+        last_character = self._last_character
+        start_position = len(self)
+        for message in messages:
+            if(message.get_character() == None and message.has_tag(MessageTag.CHARACTER)):
+                if(last_character == None):
+                    print('Warning: Message is tagged as character message, but has no character associated with it.')
+                message.fix_character(last_character)
+            if(message.get_character() != None and message.get_tag_mask() & self._SPEAKER_IGNORE_MASK == 0):
+                last_character = message.get_character()
+            position = self._offset + len(self.log)
+            self._index_message(message, position)
+            self.log.append(message)
+            for view in self._views:
+                if(view.matches(message)):
+                    view._append(message, position)
+        self._last_character = last_character
+        if(self._store != None and len(messages) > 0):
+            self._store.append(start_position, messages)
+        self._spill()
+        # messages *should* be passed by reference, so any calls of Message.fix_character 
+        # should be refelected in the returned list
         return messages
     
     def prepend_messages(self, messages: list[Message]) -> None:
+        if(self._store != None):
+            raise ValueError('Cannot prepend to a MessageLog with a store')
         self.log = messages + self.log
+        self._reindex()
+        self._spill()
+
+    # Returns a MessageView of the messages which pass the given filters. The view is updated as messages are appended, 
+    # so callers which query the same filter repeatedly should register a view once and query it, rather than re-filtering the log.
+    # If counter (a tokenizer.TokenCounter) is given, the view can also be used to find token-limited windows.
+    def register_view(self, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None, character_blacklist=None, character_whitelist=None, counter=None) -> 'MessageView':
+        assert isinstance(character_blacklist, list|None) and isinstance(character_whitelist, list|None)
+        ignore_mask = MessageTag.to_mask(MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist))
+        view = MessageView(log=self, ignore_mask=ignore_mask, 
+                           character_whitelist=(frozenset(character_whitelist) if character_whitelist != None else None),
+                           character_blacklist=(frozenset(character_blacklist) if character_blacklist != None else None),
+                           counter=counter)
+        view._rebuild()
+        self._views.append(view)
+        return view
+
+    def unregister_view(self, view: 'MessageView') -> None:
+        self._views.remove(view)
+
+    # Returns the id of the newest message in the log (see is_newer_id), or None if no message has an id
+    def get_newest_id(self) -> str|None:
+        if(self._store != None):
+            return self._store.get_newest_id()
+        return max((msg.get_id() for msg in self.log if msg.get_id() != None), default=None)
 
     def get_last_n_messages(self, n: int, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[Message]:
         ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
-        return self.get_log(tag_blacklist=ignore_tags)[-n:]
+        if(n <= 0):
+            return self.get_log(tag_blacklist=ignore_tags)[-n:]
+        # Walk back from the end rather than filtering the whole log
+        ignore_mask = MessageTag.to_mask(ignore_tags)
+        messages = []
+        for message in self._iter_messages_reversed():
+            if(len(messages) >= n):
+                break
+            if(message.get_tag_mask() & ignore_mask == 0):
+                messages.append(message)
+        messages.reverse()
+        return messages
 
     def get_log(self, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[Message]:
-        ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
-        return filter_tags(messages=self.log, tag_blacklist=ignore_tags)
+        ignore_mask = MessageTag.to_mask(MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist))
+        return [msg for msg in self._iter_messages() if msg.get_tag_mask() & ignore_mask == 0]
 
     # Does not include the message with the given id, only those posted after it
+    # If no message with the given id is found (or it has an ignored tag), returns the whole filtered log
     def get_messages_after_id(self, id: str, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[Message]:
-        ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
-        index = None
-        log = self.get_log(tag_blacklist=ignore_tags)
-        for i, message in enumerate(log):
-            if(message.get_id() == id):
-                index = i
-                break
-        if(index == None):
-            return log
+        ignore_mask = MessageTag.to_mask(MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist))
+        position = self._find(id)
+        if(position == None or self._get_message(position).get_tag_mask() & ignore_mask != 0): # type: ignore
+            return self.get_log(tag_blacklist=tag_blacklist, tag_whitelist=tag_whitelist)
         else:
-            # list slicing beyond the bounds of the list just returns an empty list, 
-            # so this should still work if `index` points to the last element in the list
-            return log[index+1:]
+            return [msg for msg in self._iter_messages(start=position+1) if msg.get_tag_mask() & ignore_mask == 0]
 
+    # Returns the longest run of the latest messages (after filtering) whose token counts, plus one per message, add up to no more than token_limit.
+    # A view is registered for each filter used, so each message is only counted once, and the run is found by binary search.
+    # Messages whose tags are changed after being appended (e.g. with Message.hide) aren't re-filtered.
     def get_token_messages(self, counter, token_limit: int, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None, character_blacklist=None, character_whitelist=None) -> list[Message]:
         if(type(token_limit) != int):
             raise TypeError("'tokens' argument of Message.get_token_messages must be an integer")
         elif(token_limit < 0):
             raise ValueError("'tokens' argument of Message.get_token_messages must be >= 0")
-        log = self.get_log(tag_blacklist=tag_blacklist, tag_whitelist=tag_whitelist)
 
         assert isinstance(character_blacklist, list|None) and isinstance(character_whitelist, list|None)
-        if(character_whitelist !=None):
-            log = [msg for msg in log if msg.get_character() in character_whitelist]
-        if(character_blacklist !=None):
-            log = [msg for msg in log if msg.get_character() not in character_blacklist]
-
-        if(len(log) == 0):
-            return []
-
-        token_count = 0
-        messages = []
-        i = len(log)-1
-        
-        while token_count < token_limit and i >= 0:
-            message = log[i]
-            token_count += message.count_tokens(counter=counter) + 1
-            if(token_count <= token_limit):
-                messages.append(message)
-            i -= 1
-        messages.reverse()
+        key = (MessageTag.to_mask(MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)), 
+               (frozenset(character_whitelist) if character_whitelist != None else None), 
+               (frozenset(character_blacklist) if character_blacklist != None else None), 
+               counter)
+        if(key not in self._token_views):
+            self._token_views[key] = self.register_view(tag_blacklist=tag_blacklist, tag_whitelist=tag_whitelist, 
+                                                        character_blacklist=character_blacklist, character_whitelist=character_whitelist, counter=counter)
+        return self._token_views[key].get_token_messages(token_limit)
+
+# The messages of a MessageLog which pass a filter (ignored tags, and character white/blacklists), kept up to date by the log as messages are appended.
+# Create these with MessageLog.register_view. Query methods behave like the MessageLog methods of the same name, restricted to the view's messages.
+# Only messages in the log's memory are held by the view. Queries which need older messages read them from the log's store.
+# If the view has a counter, prefix_sums[i] - prefix_sums[0] is the cost of messages[:i], where each message costs its token count plus one
+class MessageView():
+    def __init__(self, log: MessageLog, ignore_mask: int, character_whitelist: frozenset|None, character_blacklist: frozenset|None, counter=None):
+        self._log = log
+        self._ignore_mask = ignore_mask
+        self._character_whitelist = character_whitelist
+        self._character_blacklist = character_blacklist
+        self._counter = counter
+        self.messages = []
+        self.positions = []
+        self.prefix_sums = [0]
+
+    def matches(self, message: Message) -> bool:
+        if(message.get_tag_mask() & self._ignore_mask != 0):
+            return False
+        if(self._character_whitelist != None and message.get_character() not in self._character_whitelist):
+            return False
+        if(self._character_blacklist != None and message.get_character() in self._character_blacklist):
+            return False
+        return True
+
+    def _append(self, message: Message, position: int) -> None:
+        self.messages.append(message)
+        self.positions.append(position)
+        if(self._counter != None):
+            self.prefix_sums.append(self.prefix_sums[-1] + message.count_tokens(counter=self._counter) + 1)
+
+    # Returns up to limit (score, position, message) tuples of the view's messages before position `before` which best match terms,
+    # best first (see MessageStore.search)
+    def search(self, terms: list[str], limit: int, before: int) -> list[tuple[float, int, Message]]:
+        results = []
+        for score, position, message in self._log._search(terms, before=before):
+            if(len(results) >= limit):
+                break
+            if(self.matches(message)):
+                results.append((score, position, message))
+        return results
+
+    # Position of the message in the log, or None if it has no id
+    def get_position(self, message: Message) -> int|None:
+        if(message.get_id() == None):
+            return None
+        return self._log._find(message.get_id()) # type: ignore
+
+    # Tokens the messages take up in a prompt, as counted by get_token_messages
+    def count_cost(self, messages: list[Message]) -> int:
+        assert self._counter != None, 'This view was registered without a counter'
+        return sum(message.count_tokens(counter=self._counter) + 1 for message in messages)
+
+    # Refills the view from the log's in-memory messages
+    def _rebuild(self) -> None:
+        self.messages = []
+        self.positions = []
+        self.prefix_sums = [0]
+        for position, message in enumerate(self._log.log, start=self._log._offset):
+            if(self.matches(message)):
+                self._append(message, position)
+
+    # Drops messages before position offset
+    def _trim(self, offset: int) -> None:
+        count = bisect_left(self.positions, offset)
+        del self.messages[:count]
+        del self.positions[:count]
+        if(self._counter != None):
+            del self.prefix_sums[:count]
+
+    # Yields the view's messages from the log's store, latest first
+    def _iter_stored_reversed(self) -> Iterator[Message]:
+        for message in self._log._iter_messages_reversed(end=self._log._offset):
+            if(self.matches(message)):
+                yield message
+
+    def get_log(self) -> list[Message]:
+        if(self._log._offset == 0):
+            return self.messages[:]
+        stored = list(self._iter_stored_reversed())
+        stored.reverse()
+        return stored + self.messages
+
+    def get_last_message(self) -> Message|None:
+        last = self.get_last_n_messages(1)
+        return (last[0] if len(last) > 0 else None)
+
+    def get_last_n_messages(self, n: int) -> list[Message]:
+        if(n <= 0):
+            return self.get_log()[-n:]
+        messages = self.messages[-n:]
+        if(len(messages) < n and self._log._offset > 0):
+            stored = []
+            for message in self._iter_stored_reversed():
+                if(len(stored) + len(messages) >= n):
+                    break
+                stored.append(message)
+            stored.reverse()
+            messages = stored + messages
         return messages
-            
\ No newline at end of file
+
+    # Does not include the message with the given id, only those posted after it
+    # If no message in the view has the given id, returns the whole view
+    def get_messages_after_id(self, id: str) -> list[Message]:
+        position = self._log._find(id)
+        if(position == None or not self.matches(self._log._get_message(position))): # type: ignore
+            return self.get_log()
+        if(position >= self._log._offset):
+            return self.messages[bisect_left(self.positions, position+1):]
+        return [msg for msg in self._log._iter_messages(start=position+1) if self.matches(msg)]
+
+    # Like get_messages_after_id, but messages are read from the log as they're iterated, so callers that stop early don't read the rest.
+    # If no message in the log has the given id, starts from the first message with a newer id (see is_newer_id)
+    def iter_messages_after_id(self, id: str) -> Iterator[Message]:
+        for message in self._log._iter_messages(start=self._log._find_after(id)):
+            if(self.matches(message)):
+                yield message
+
+    def get_token_messages(self, token_limit: int) -> list[Message]:
+        assert self._counter != None, 'This view was registered without a counter'
+        if(type(token_limit) != int):
+            raise TypeError("'tokens' argument of MessageView.get_token_messages must be an integer")
+        elif(token_limit < 0):
+            raise ValueError("'tokens' argument of MessageView.get_token_messages must be >= 0")
+
+        # The earliest start whose suffix costs no more than token_limit. Every message costs at least 1, so prefix_sums is strictly increasing
+        start = bisect_left(self.prefix_sums, self.prefix_sums[-1] - token_limit)
+        if(start > 0 or self._log._offset == 0):
+            return self.messages[start:]
+
+        # Every in-memory message fits, so carry on into the store
+        remaining_tokens = token_limit - (self.prefix_sums[-1] - self.prefix_sums[0])
+        older_messages = []
+        for message in self._iter_stored_reversed():
+            cost = message.count_tokens(counter=self._counter) + 1
+            if(cost > remaining_tokens):
+                break
+            older_messages.append(message)
+            remaining_tokens -= cost
+        older_messages.reverse()
+        return older_messages + self.messages
@@ -8,13 +8,16 @@ from selenium.common.exceptions import TimeoutException;
 from selenium.webdriver.support.select import Select
 from selenium.webdriver.remote.webelement import WebElement
 
+import functools
 import threading
 import os;
 import re
-from time import sleep
+from typing import Iterator
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 from messages import MessageTag
 from messages import SYSTEM_TAGS
+from actor import Actor, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 
 from globals import *
 
@@ -27,48 +30,323 @@ CF_CLEARANCE_TIMEOUT = 5
 CF_CLEARANCE_RETRY_TIMEOUT = 10
 GAME_CONNECT_TIMEOUT = 10
 
+# Firefox preferences used in chat-only mode. These stop the browser loading images and media and rendering 3D/WebGL content,
+# none of which the bot needs to read or post chat messages.
+CHAT_ONLY_FIREFOX_PREFERENCES = {
+    "permissions.default.image" : 2,        # block all images
+    "media.autoplay.default" : 5,           # block all autoplaying audio and video
+    "media.peerconnection.enabled" : False, # no WebRTC (Roll20 voice/video chat)
+    "media.navigator.enabled" : False,
+    "webgl.disabled" : True,
+    "dom.ipc.processCount" : 1,             # one content process is plenty for one page
+}
+
+# Elements of the Roll20 editor which are hidden in chat-only mode
+TABLETOP_ELEMENT_IDS = ["editor-wrapper", "playerzone", "babylonCanvas", "floatingtoolbar", "page-toolbar"]
+
+# Serializes a message element to [content, by, id, classes].
+# `by` is the speaker label (e.g. "Name:") if the message has one.
+_SERIALIZE_MESSAGE_JS = """
+function serializeMessage(elem) {
+    var by = elem.querySelector('.by');
+    return [
+        elem.innerText,
+        (by ? by.innerText : null),
+        elem.getAttribute('data-messageid'),
+        Array.from(elem.classList)
+    ];
+}
+"""
+
+# Returns serialized messages for every message element passed in as arguments[0]
+EXTRACT_MESSAGES_SCRIPT = _SERIALIZE_MESSAGE_JS + """
+return arguments[0].map(serializeMessage);
+"""
+
+# Installs a MutationObserver on the chat content node (arguments[0]) which queues every message node added to it.
+# Nodes are only serialized when the queue is drained, so that messages which finish rendering after insertion are read whole.
+START_MESSAGE_FEED_SCRIPT = """
+var content = arguments[0];
+var feed = window.__r20botFeed;
+if (feed && feed.target === content) {
+    return;
+}
+if (feed) {
+    feed.observer.disconnect();
+}
+feed = {target: content, queue: []};
+feed.observer = new MutationObserver(function(mutations) {
+    mutations.forEach(function(mutation) {
+        mutation.addedNodes.forEach(function(node) {
+            if (node.nodeType === Node.ELEMENT_NODE && node.classList.contains('message')) {
+                feed.queue.push(node);
+            }
+        });
+    });
+});
+feed.observer.observe(content, {childList: true});
+window.__r20botFeed = feed;
+"""
+
+# Returns every message queued by the feed since the last drain, or null if the feed isn't installed (e.g. the page was reloaded)
+DRAIN_MESSAGE_FEED_SCRIPT = _SERIALIZE_MESSAGE_JS + """
+var feed = window.__r20botFeed;
+if (!feed) {
+    return null;
+}
+var queue = feed.queue;
+feed.queue = [];
+return queue.map(serializeMessage);
+"""
+
+# Returns serialized messages for every message node in the chat content node (arguments[0]) after the read cursor.
+# The cursor is the last node read by a previous call. It is only used if it is still attatched to the chat and arguments[2] is true,
+# otherwise reading starts after the message with id arguments[1] (or at the top of the chat if that can't be found either).
+READ_MESSAGES_AFTER_CURSOR_SCRIPT = _SERIALIZE_MESSAGE_JS + """
+var content = arguments[0];
+var id = arguments[1];
+var cursor = window.__r20botCursor;
+if (!arguments[2] || !cursor || cursor.parentNode !== content) {
+    cursor = null;
+    if (id !== null) {
+        cursor = content.querySelector(':scope > div[data-messageid="' + CSS.escape(id) + '"]');
+    }
+}
+var messages = [];
+var node = (cursor ? cursor.nextElementSibling : content.firstElementChild);
+for (; node !== null; node = node.nextElementSibling) {
+    if (node.classList.contains('message')) {
+        messages.push(serializeMessage(node));
+        cursor = node;
+    }
+}
+window.__r20botCursor = cursor;
+return messages;
+"""
+
+# Returns the number of pages in a paginated chat archive
+ARCHIVE_PAGE_COUNT_SCRIPT = """
+var pages = 1;
+document.querySelectorAll('.pagination a').forEach(function(link) {
+    var page = parseInt(link.textContent, 10);
+    if (!isNaN(page) && page > pages) {
+        pages = page;
+    }
+});
+return pages;
+"""
+
+# Hides the tabletop (map canvas, player avatars, toolbars) and stops any playing media, leaving the chat panel intact.
+# arguments[0] is a list of ids of elements to hide
+HIDE_TABLETOP_SCRIPT = """
+var chat = document.getElementById('textchat');
+arguments[0].forEach(function(id) {
+    var elem = document.getElementById(id);
+    if (elem && !elem.contains(chat)) {
+        elem.style.display = 'none';
+    }
+});
+document.querySelectorAll('audio, video').forEach(function(media) {
+    media.pause();
+    media.removeAttribute('src');
+    media.load();
+});
+"""
+
+TYPING_INDICATOR_INTERVAL = 0.3
+
+# Returns [text, value] for every option of the "speaking as" select element (arguments[0])
+READ_SPEAKING_AS_SCRIPT = """
+return Array.from(arguments[0].options).map(function(option) {
+    return [option.text, option.value];
+});
+"""
+
+# Longer messages are split into several posts
+MAX_CHAT_MESSAGE_LENGTH = 1000
+
+# Sets the value of the chat input (arguments[0]) to arguments[1] and fires the events that typing into it would
+SET_CHAT_INPUT_SCRIPT = """
+var input = arguments[0];
+input.value = arguments[1];
+input.dispatchEvent(new Event('input', {bubbles: true}));
+input.dispatchEvent(new Event('change', {bubbles: true}));
+"""
+
+# Decorator for Roll20 methods that use the WebDriver. The method is run on the browser's WebDriver thread,
+# which is the only thread that ever touches the WebDriver session. The calling thread waits for the result.
+# Before the method runs, the browser is switched to the Roll20 object's tab.
+def _on_driver_thread(priority=PRIORITY_NORMAL):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if(self._actor.is_actor_thread()):
+                # Called from another driver-thread method, which has already switched to the right window
+                return method(self, *args, **kwargs)
+            return self._actor.call(self._run_in_tab, method, *args, priority=priority, **kwargs)
+        return wrapper
+    return decorator
+
+# One browser, shared by every Roll20 object opened in it (one per tab)
+class _BrowserSession():
+    def __init__(self) -> None:
+        self.driver = None
+        # Every WebDriver call is made from this thread. Other threads queue work for it (see _on_driver_thread).
+        # Tasks of equal priority run in the order they were queued, so games sharing the browser are served in turn
+        self.actor = Actor(name='webdriver')
+        # Tracked here so that switching windows only costs a WebDriver call when the window actually changes
+        self.current_window = None
+
+    # Must be called from the actor thread
+    def switch_to(self, window: str) -> None:
+        assert self.driver is not None
+        if(self.current_window != window):
+            self.driver.switch_to.window(window)
+            self.current_window = window
+
 # This class is a mess. It's also the most liable to break, so sorry about that.
 # To use this class, make sure $R20_CF_CLEARANCE, $R20_PASSWORD, and $R20_EMAIL are set
+# Each Roll20 object plays in one game. To play in several games in one browser, create the first Roll20 object normally,
+# log in with it, and then create one more for each extra game with share_session_with set to the first. Each gets its own tab.
 class Roll20():
-    def __init__(self, driver_args: list[str]) -> None:
+    # If chat_only is True, the browser won't load images or media or render WebGL, and the tabletop is hidden once a game is joined
+    # If fast_post is True, messages are posted by setting the chat input's value instead of typing them out one key at a time
+    # If share_session_with is given, driver_args and chat_only are ignored and a new tab is opened in that Roll20 object's browser
+    def __init__(self, driver_args: list[str]|None=None, chat_only=False, fast_post=True, share_session_with: 'Roll20|None'=None) -> None:
         # chat interaction elements
         self._char_select = None
+        self._char_select_elem = None
         self._chat_input = None
         self._chat_send = None
         self._chat_history = None
         self._chat_window = None
 
+        # Cached map of "speaking as" option names to values. None until first read
+        self._roster = None
+
+        # handle of this object's tab
+        self._window = None
+        # handle of the chat archive window while it's open
+        self._archive_window = None
+
+        # id of the message that the next get_messages_after_id call is expected to read after if the page's read cursor is still valid
+        self._cursor_id = None
+
+        # typing indicator state
+        self._typing_thread = None
+        self._typing_stop_event = threading.Event()
+        self._typed_chars = 0
+
+        self._fast_post = fast_post
+        if(share_session_with == None):
+            self._owns_session = True
+            self._chat_only = chat_only
+            self._session = _BrowserSession()
+            self._actor = self._session.actor
+            self._actor.call(self._start_driver, (driver_args if driver_args != None else []))
+        else:
+            self._owns_session = False
+            self._chat_only = share_session_with._chat_only
+            self._session = share_session_with._session
+            self._actor = self._session.actor
+            self._actor.call(self._open_tab)
+        assert self._session.driver is not None
+        self.driver = self._session.driver
+
+    def __del__(self):
+        self.close()
+
+    # Closes this object's tab, or the whole browser if this object opened it
+    def close(self) -> None:
+        actor = getattr(self, '_actor', None)
+        if(actor == None or not actor.is_alive()):
+            return
+        self.stop_typing()
+        if(self._owns_session):
+            if(self._session.driver != None):
+                actor.call(self._session.driver.quit)
+            actor.stop()
+        elif(self._window != None):
+            actor.call(self._close_tab)
+
+    def _start_driver(self, driver_args: list[str]) -> None:
         options = webdriver.FirefoxOptions()
         for arg in driver_args:
             options.add_argument(arg)
+        if(self._chat_only):
+            for preference, value in CHAT_ONLY_FIREFOX_PREFERENCES.items():
+                options.set_preference(preference, value)
         self.driver = webdriver.Firefox(options=options)
+        self._session.driver = self.driver
+        self._window = self.driver.current_window_handle
+        self._session.current_window = self._window
         
         self.driver.get(ROLL20_URL)
         self.update_cf_clearance(os.environ[ENV_CF_CLEARANCE])
 
-    def __del__(self):
-        self.driver.quit()
+    def _open_tab(self) -> None:
+        assert self._session.driver is not None
+        self._session.driver.switch_to.new_window('tab')
+        self._window = self._session.driver.current_window_handle
+        self._session.current_window = self._window
 
+    def _close_tab(self) -> None:
+        self._session.switch_to(self._window)
+        self.driver.close()
+        self._session.current_window = None
+        self._window = None
+
+    def _run_in_tab(self, method, *args, **kwargs):
+        self._session.switch_to(self._window)
+        return method(self, *args, **kwargs)
+
+    @_on_driver_thread()
     def controls_character(self, character: str|None) -> bool:
         if(character == None):
             return False
-        assert self._char_select is not None
-        for option in self._char_select.options:
-            if(option.text == character):
-                return True
-        return False
+        return self._get_character_value(character) != None
     
+    @_on_driver_thread()
     def get_player_name(self) -> str|None:
-        assert self._char_select is not None
-        for option in self._char_select.options:
-            value = option.get_attribute('value')
-            if(value != None and 'PLAYER' in value.upper()):
-                return option.text
+        for name, value in self._get_roster().items():
+            if('PLAYER' in value.upper()):
+                return name
         return None
 
+    # Returns the cached {name : value} map of the "speaking as" options, reading it from the page first if needed
+    def _get_roster(self, refresh=False) -> dict[str, str]:
+        assert self._char_select is not None
+        if(self._roster == None or refresh):
+            self._roster = {}
+            for name, value in self.driver.execute_script(READ_SPEAKING_AS_SCRIPT, self._char_select_elem):
+                # Like select_by_visible_text, prefer the first option with a given name
+                self._roster.setdefault(name, value)
+        return self._roster
+
+    # Returns the "speaking as" value for the named character, or None if this account can't post as them.
+    # The cached roster is re-read once before giving up, in case the account has been given new characters
+    def _get_character_value(self, character: str) -> str|None:
+        value = self._get_roster().get(character)
+        if(value == None):
+            value = self._get_roster(refresh=True).get(character)
+        return value
+
+    def _select_character(self, character: str) -> None:
+        assert self._char_select is not None
+        value = self._get_character_value(character)
+        if(value == None):
+            raise WebDriverExceptions.NoSuchElementException(f'Cannot post as "{character}"')
+        try:
+            self._char_select.select_by_value(value)
+        except WebDriverExceptions.NoSuchElementException as e:
+            # The option has gone, so the cache is stale
+            self._roster = None
+            raise e
+
     '''Message posting methods'''
 
     # precondition: must already be on app.roll20.net
+    @_on_driver_thread()
     def update_cf_clearance(self, token: str) -> None:
         os.environ[ENV_CF_CLEARANCE] = token
         self._update_cf_cookie()
@@ -83,6 +361,7 @@ class Roll20():
         }
         self.driver.add_cookie(self._cf_clearance_cookie)
 
+    @_on_driver_thread(PRIORITY_HIGH)
     def post_with_id(self, text: str, id: str):
         try:
             assert self._char_select is not None
@@ -91,113 +370,248 @@ class Roll20():
         except WebDriverExceptions.NoSuchElementException as e:
             print(f"Failed to post as character with ID \"{id}\". Check that the ID is correct and that this account has permission to post as this character")
 
+    @_on_driver_thread(PRIORITY_HIGH)
     def post_with_name(self, text: str, character: str):
         try:
-            assert self._char_select is not None
-            self._char_select.select_by_visible_text(character)
+            self._select_character(character)
             self._post(text)
         except WebDriverExceptions.NoSuchElementException as e:
             print(f"Failed to post as \"{character}\". Check that the name is correct and that this account has permission to post as this character")
 
+    # Each line of text is posted as a separate message (as happens when typing a newline into Roll20 chat)
     def _post(self, text: str) -> None:
         assert self._chat_input is not None
         assert self._chat_send is not None
-        self._chat_input.clear()
-        self._chat_input.send_keys(text)
-        self._chat_send.click()
-
-    def idle(self, as_character: str, stop_event : threading.Event):
-        assert self._chat_input is not None
-        assert self._char_select is not None
+        for chunk in Roll20._split_message(text):
+            if(self._fast_post):
+                self.driver.execute_script(SET_CHAT_INPUT_SCRIPT, self._chat_input, chunk)
+            else:
+                self._chat_input.clear()
+                self._chat_input.send_keys(chunk)
+            self._typed_chars = 0
+            self._chat_send.click()
+
+    # Splits text into its non-empty lines, and splits lines longer than max_length at the last sentence end or space that fits
+    @staticmethod
+    def _split_message(text: str, max_length=MAX_CHAT_MESSAGE_LENGTH) -> list[str]:
+        chunks = []
+        for line in text.splitlines():
+            line = line.strip()
+            while len(line) > max_length:
+                split = max(line.rfind('. ', 0, max_length), line.rfind('! ', 0, max_length), line.rfind('? ', 0, max_length))
+                if(split > 0):
+                    split += 1 # keep the punctuation
+                else:
+                    split = line.rfind(' ', 0, max_length)
+                if(split <= 0):
+                    split = max_length
+                chunks.append(line[:split].strip())
+                line = line[split:].strip()
+            if(line != ''):
+                chunks.append(line)
+        return chunks
+
+    # Shows the "is typing" indicator as as_character until stop_typing() is called.
+    # Keystrokes are queued at low priority, so they never hold up reading or posting messages.
+    def start_typing(self, as_character: str) -> None:
+        self.stop_typing()
+        self._typing_stop_event.clear()
+        self._typing_thread = threading.Thread(name='typing', daemon=True, target=self._type_until_stopped, args=(as_character,))
+        self._typing_thread.start()
+
+    def stop_typing(self) -> None:
+        if(self._typing_thread == None):
+            return
+        self._typing_stop_event.set()
+        self._typing_thread.join()
+        self._typing_thread = None
+
+    # Runs on the typing thread. Each keystroke is queued on the driver thread at low priority, so posts and reads go first
+    def _type_until_stopped(self, as_character: str) -> None:
+        self._select_typing_character(as_character)
+        # Keep one character in the input so the indicator doesn't flicker, and toggle a second one
+        self._type_key('a')
+        while(not self._typing_stop_event.wait(TYPING_INDICATOR_INTERVAL)):
+            self._type_key('a' if self._typed_chars < 2 else Keys.BACKSPACE)
+        self._clear_typed_keys()
+
+    @_on_driver_thread(PRIORITY_LOW)
+    def _select_typing_character(self, as_character: str) -> None:
         try:
-            self._char_select.select_by_visible_text(as_character)
-        except:
+            self._select_character(as_character)
+        except WebDriverExceptions.NoSuchElementException:
             pass
-        self._chat_input.send_keys('a')
-        while(not stop_event.is_set()):
-            self._chat_input.send_keys('a')
-            sleep(0.3)
-            self._chat_input.send_keys(Keys.BACKSPACE)
-            sleep(0.3)
-        self._chat_input.send_keys(Keys.BACKSPACE)
+
+    @_on_driver_thread(PRIORITY_LOW)
+    def _type_key(self, key: str) -> None:
+        assert self._chat_input is not None
+        self._chat_input.send_keys(key)
+        self._typed_chars += (-1 if key == Keys.BACKSPACE else 1)
+
+    @_on_driver_thread(PRIORITY_LOW)
+    def _clear_typed_keys(self) -> None:
+        while(self._typed_chars > 0):
+            self._type_key(Keys.BACKSPACE)
 
     '''Message reading methods'''
 
     # get the last n messages. Will only scan messages up to the top of the editor (won't scan through chat archive)
     # If n is greater than the number of visible messages, will only return visible messages. Messages with ignored tags won't be counted.
+    @_on_driver_thread()
     def get_last_n_messages(self, n: int, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]:
         assert self._chat_window is not None
 
         ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
-        locator = "div[contains(@class,'message')]" 
-        total_msgs = len(self._chat_window.find_elements(By.XPATH, locator))
-        position = total_msgs
+        msg_elems = self._chat_window.find_elements(By.XPATH, "div[contains(@class,'message')]")
+        raw_messages = Roll20._extract_raw_message_info_list(msg_elems)
+
+        # Walk back from the newest message until n messages without ignored tags have been seen
+        position = len(raw_messages)
         message_count = 0
-        messages = []
         while position > 0 and message_count < n:
-            # I don't know how find_elements orders results, so I access their positions with an XPath query
-            elem = self._chat_window.find_element(By.XPATH, f"{locator}[position() = {position}]")
-            msg = Roll20._extract_message_info(elem)
-            # append message if it doesn't have an ignored tag
-            if(not Roll20._has_unwanted_tags(msg, ignore_tags)):
-                message_count += 1
             position -= 1
+            if(not Roll20._tags_from_classes(raw_messages[position][3]).intersection(ignore_tags)):
+                message_count += 1
 
-        elems = self._chat_window.find_elements(By.XPATH, f"{locator}[position() > {position} and position() <= {total_msgs}]")
-        messages = Roll20._extract_message_info_list(elems, ignore_tags)
-        return messages
+        # Messages before `position` are still processed so that speakerless character messages can inherit a name
+        messages = Roll20._process_raw_message_info_list(raw_messages, tag_blacklist=set())
+        return Roll20._filter_unwanted_tags(messages[position:], ignore_tags)
 
     # get a list of messages posted after the message with the provided ID. Will only scan messages up to the top of the editor (won't scan through chat archive)
     # If the ID can't be found, will return every visible message
+    # A read cursor is kept in the page, so when called with the id of the last message returned by the previous call, only newer nodes are touched.
+    @_on_driver_thread()
     def get_messages_after_id(self, id: str, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]:
         assert self._chat_window is not None
 
         ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
-        limiting_msg_elem = self._chat_window.find_elements(By.XPATH, f"div[@data-messageid='{id}']")
+        use_cursor = (self._cursor_id != None and self._cursor_id == id)
+        raw_messages = self.driver.execute_script(READ_MESSAGES_AFTER_CURSOR_SCRIPT, self._chat_window, id, use_cursor)
+        messages = Roll20._process_raw_message_info_list(raw_messages, ignore_tags)
 
-        if len(limiting_msg_elem) == 0:
-            position = 0
-        else:
-            limiting_msg_elem = limiting_msg_elem[0]
-            position = self._chat_window.find_elements(By.XPATH, "div[contains(@class,'message')]").index(limiting_msg_elem) + 1 #add one because XPATH indexes elements from 1, not 0
+        # Callers pass the id of the last message they were given
+        self._cursor_id = (messages[-1][2] if len(messages) > 0 else id)
+        return messages
 
-        msg_elems = self._chat_window.find_elements(By.XPATH, f"div[contains(@class,'message')][position() > {position}]")
-        return Roll20._extract_message_info_list(msg_elems, ignore_tags)
+    # Starts queueing new chat messages in the page. Queued messages are collected with drain_new_messages().
+    # Calling this while the feed is already running does nothing.
+    @_on_driver_thread()
+    def start_message_feed(self) -> None:
+        assert self._chat_window is not None
+        self.driver.execute_script(START_MESSAGE_FEED_SCRIPT, self._chat_window)
+
+    # Returns every message posted since the last call (or since start_message_feed() was called), with a single script call.
+    # Returns None if the feed isn't running, in which case start_message_feed() must be called again and messages may have been missed.
+    @_on_driver_thread()
+    def drain_new_messages(self, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]|None:
+        ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
+        raw_messages = self.driver.execute_script(DRAIN_MESSAGE_FEED_SCRIPT)
+        if(raw_messages == None):
+            return None
+        return Roll20._process_raw_message_info_list(raw_messages, ignore_tags)
 
     # returns a list of lists of the form (content: str, character: str, id: str, tags: list[MessageTag])
     # Will ignore hidden messages, system messages and dice results (unless you change the ignore_tags)
+    # This renders the whole archive on one page. For long campaigns, use iter_all_messages() instead
+    @_on_driver_thread()
     def get_all_messages(self, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]:
-        assert self._chat_history is not None
-
         ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)          
-        original_window = self.driver.current_window_handle
-        assert len(self.driver.window_handles) == 1
+        original_window = self._open_chat_archive()
+        wait = WebDriverWait(self.driver, 10)
+
+        # display all messages on one page if not already
+        if(self.driver.find_element(By.ID, 'paginateToggle').text == 'Show on One Page'):
+            self.driver.find_element(By.ID, "paginateToggle").click()
+
+        wait.until(EC.visibility_of_element_located((By.XPATH, "//div[@id='textchat']/div/div[contains(@class,'message')]")))
+        messages = self._read_archive_page(ignore_tags)
+
+        self._close_chat_archive(original_window)
+        return(messages)
+
+    # Walks the chat archive page by page, oldest page first (or newest first if newest_first is set), yielding (page number, page count, messages) for each page.
+    # Messages are of the same form as those returned by get_all_messages(). If max_pages is given, only the last max_pages pages are read.
+    # The archive window is closed once the generator is exhausted or closed.
+    def iter_all_messages(self, max_pages: int|None=None, newest_first=False, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> Iterator[tuple[int, int, list[list]]]:
+        ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
+        original_window = self._open_chat_archive()
+        try:
+            archive_url, page_count = self._paginate_chat_archive()
+            first_page = (1 if max_pages == None else max(1, page_count - max_pages + 1))
+
+            pages = range(first_page, page_count+1)
+            for page in (reversed(pages) if newest_first else pages):
+                yield (page, page_count, self._read_archive_page_at(archive_url, page, ignore_tags))
+        finally:
+            self._close_chat_archive(original_window)
+
+    # Switches the open chat archive to show messages over multiple pages. Returns the archive's URL and the number of pages
+    @_on_driver_thread()
+    def _paginate_chat_archive(self) -> tuple[str, int]:
+        self._switch_to_chat_archive()
+        if(self.driver.find_element(By.ID, 'paginateToggle').text != 'Show on One Page'):
+            self.driver.find_element(By.ID, "paginateToggle").click()
+            WebDriverWait(self.driver, 10).until(EC.text_to_be_present_in_element((By.ID, 'paginateToggle'), 'Show on One Page'))
+
+        page_count = self.driver.execute_script(ARCHIVE_PAGE_COUNT_SCRIPT)
+        assert isinstance(page_count, int)
+        return (self.driver.current_url, page_count)
+
+    @_on_driver_thread()
+    def _read_archive_page_at(self, archive_url: str, page: int, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]:
+        self._switch_to_chat_archive()
+        self.driver.get(Roll20._archive_page_url(archive_url, page))
+        WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, 'textchat')))
+        return self._read_archive_page(tag_blacklist, tag_whitelist)
+
+    # Opens the chat archive in a new window and switches to it. Returns the handle of the original window
+    @_on_driver_thread()
+    def _open_chat_archive(self) -> str:
+        assert self._chat_history is not None
+        original_window = self._window
+        existing_windows = set(self.driver.window_handles)
 
         # open chat archive
         self._chat_history.click()
         wait = WebDriverWait(self.driver, 10)
-        wait.until(EC.number_of_windows_to_be(2))
+        wait.until(EC.number_of_windows_to_be(len(existing_windows) + 1))
 
         # switch to chat archive
         for window_handle in self.driver.window_handles:
-            if window_handle != original_window:
-                self.driver.switch_to.window(window_handle)
+            if window_handle not in existing_windows:
+                self._archive_window = window_handle
+                self._session.switch_to(window_handle)
                 break
-        
-        # display all messages on one page if not already
+
         wait.until(EC.visibility_of_element_located((By.ID, 'paginateToggle')))
-        if(self.driver.find_element(By.ID, 'paginateToggle').text == 'Show on One Page'):
-            self.driver.find_element(By.ID, "paginateToggle").click()
+        return original_window
 
-        wait.until(EC.visibility_of_element_located((By.XPATH, "//div[@id='textchat']/div/div[contains(@class,'message')]")))
+    @_on_driver_thread()
+    def _close_chat_archive(self, original_window: str) -> None:
+        self._switch_to_chat_archive()
+        self.driver.close()
+        self._archive_window = None
+        self._session.current_window = None
+        self._session.switch_to(original_window)
+        WebDriverWait(self.driver, 10).until(EC.url_to_be("https://app.roll20.net/editor/"))
+
+    # Driver-thread methods start in this object's tab, so methods which work on an open chat archive must switch back to it first
+    def _switch_to_chat_archive(self) -> None:
+        assert self._archive_window is not None
+        self._session.switch_to(self._archive_window)
+
+    # Reads every message on the currently displayed archive page
+    def _read_archive_page(self, tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]:
+        ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
         msg_elems = self.driver.find_element(By.ID, 'textchat').find_elements(By.XPATH, "div/div[contains(@class,'message')]")
-        
-        messages = Roll20._extract_message_info_list(msg_elems, ignore_tags)
+        return Roll20._extract_message_info_list(msg_elems, ignore_tags)
 
-        self.driver.close()
-        self.driver.switch_to.window(original_window)
-        wait.until(EC.url_to_be("https://app.roll20.net/editor/"))
-        return(messages)
+    @staticmethod
+    def _archive_page_url(archive_url: str, page: int) -> str:
+        url = urlsplit(archive_url)
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        query['p'] = str(page)
+        return urlunsplit(url._replace(query=urlencode(query)))
 
     '''Static methods for extracting information from messages'''
 
@@ -205,13 +619,31 @@ class Roll20():
     # returns a list of lists of the form (content: str, character: str, id: str, tags: set[MessageTag])
     @staticmethod
     def _extract_message_info_list(message_elems: list[WebElement], tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]:
+        ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
+        raw_messages = Roll20._extract_raw_message_info_list(message_elems)
+        return Roll20._process_raw_message_info_list(raw_messages, ignore_tags)
+
+    # Pulls the raw content, speaker, id and classes of every message element with a single execute_script call,
+    # rather than making several WebDriver round-trips per message.
+    # returns a list of lists of the form (content: str, by: str|None, id: str|None, classes: list[str])
+    @staticmethod
+    def _extract_raw_message_info_list(message_elems: list[WebElement]) -> list[list]:
+        if(len(message_elems) == 0):
+            return []
+        # WebElement.parent is the WebDriver that found the element
+        raw_messages = message_elems[0].parent.execute_script(EXTRACT_MESSAGES_SCRIPT, message_elems)
+        assert isinstance(raw_messages, list)
+        return raw_messages
+
+    # Turns raw message info (see _extract_raw_message_info_list) into the (content, character, id, tags) form
+    @staticmethod
+    def _process_raw_message_info_list(raw_messages: list[list], tag_blacklist=SYSTEM_TAGS, tag_whitelist=None) -> list[list]:
         ignore_tags = MessageTag.to_blacklist(blacklist=tag_blacklist, whitelist=tag_whitelist)
         last_character = None
         messages = []
 
-
-        for message_elem in message_elems:
-            message = Roll20._extract_message_info(message_elem)
+        for raw_message in raw_messages:
+            message = Roll20._process_raw_message_info(raw_message)
             if (MessageTag.CHARACTER in message[3]):
 
                 # If no associated name, inherit from last character message
@@ -230,27 +662,26 @@ class Roll20():
         # filter out messages with unwanted tags
         messages = Roll20._filter_unwanted_tags(messages, ignore_tags)
         return messages
-    
+
     @staticmethod
     def _extract_message_info(message_elem: WebElement) -> list:
-        tags = set()
-        by = None
-        content = message_elem.get_property("innerText")
+        return Roll20._process_raw_message_info(Roll20._extract_raw_message_info_list([message_elem])[0])
 
-        if(Roll20._is_character_message(message_elem)):
-            by_elem = message_elem.find_elements(By.CLASS_NAME, "by")
-            if(len(by_elem) > 0):
-                # Has character name attatched
-                by = by_elem[0].get_property("innerText")
+    @staticmethod
+    def _process_raw_message_info(raw_message: list) -> list:
+        content, by, id, classes = raw_message
+        tags = Roll20._tags_from_classes(classes)
+
+        if(MessageTag.CHARACTER in tags):
             if(by != None):
+                # Has character name attatched
                 assert isinstance(content, str)
                 assert isinstance(by, str)
                 content = content.removeprefix(by).strip()
                 by = by.removesuffix(':').removesuffix(' (GM)')
-            
-        id = message_elem.get_attribute("data-messageid")
+        else:
+            by = None
 
-        tags = Roll20._get_message_tags(message_elem)
         return [content, by, id, tags]
 
     @staticmethod
@@ -264,56 +695,46 @@ class Roll20():
         return any(tag in message[3] for tag in ignore_tags)
 
     @staticmethod
-    def _get_message_tags(message_elem: WebElement) -> set[MessageTag]:
+    def _tags_from_classes(classes: list[str]) -> set[MessageTag]:
         tags = set()
-        if(Roll20._is_character_message(message_elem)):
+        if(Roll20._is_character_message(classes)):
             tags.add(MessageTag.CHARACTER)
-        if(Roll20._is_system_message(message_elem)):
+        if(Roll20._is_system_message(classes)):
             tags.add(MessageTag.SYSTEM)
-        if(Roll20._is_emote_message(message_elem)):
+        if(Roll20._is_emote_message(classes)):
             tags.add(MessageTag.EMOTE)
-        if(Roll20._is_dice_message(message_elem)):
+        if(Roll20._is_dice_message(classes)):
             tags.add(MessageTag.DICE)
-        if(Roll20._is_hidden_message(message_elem)):
+        if(Roll20._is_hidden_message(classes)):
             tags.add(MessageTag.HIDDEN)
-        if(Roll20._is_desc_message(message_elem)):
+        if(Roll20._is_desc_message(classes)):
             tags.add(MessageTag.DESCRIPTION)
         return tags
 
+    # The following take the class list of a message element
+
     @staticmethod
-    def _is_character_message(elem: WebElement):
-        assert isinstance(elem, WebElement)
-        classes = elem.get_attribute('class').split() # type: ignore
+    def _is_character_message(classes: list[str]):
         return 'general' in classes
 
     @staticmethod
-    def _is_system_message(elem: WebElement):
-        assert isinstance(elem, WebElement)
-        classes = elem.get_attribute('class').split() # type: ignore
+    def _is_system_message(classes: list[str]):
         return 'system' in classes or 'news' in classes
 
     @staticmethod
-    def _is_emote_message(elem: WebElement):
-        assert isinstance(elem, WebElement)
-        classes = elem.get_attribute('class').split() # type: ignore
+    def _is_emote_message(classes: list[str]):
         return 'emote' in classes
 
     @staticmethod
-    def _is_dice_message(elem: WebElement):
-        assert isinstance(elem, WebElement)
-        classes = elem.get_attribute('class').split() # type: ignore
+    def _is_dice_message(classes: list[str]):
         return 'rollresult' in classes
     
     @staticmethod
-    def _is_desc_message(elem: WebElement):
-        assert isinstance(elem, WebElement)
-        classes = elem.get_attribute('class').split() # type: ignore
+    def _is_desc_message(classes: list[str]):
         return 'desc' in classes
     
     @staticmethod
-    def _is_hidden_message(elem: WebElement):
-        assert isinstance(elem, WebElement)
-        classes = elem.get_attribute('class').split() # type: ignore
+    def _is_hidden_message(classes: list[str]):
         return 'hidden-message' in classes
 
     '''
@@ -322,6 +743,7 @@ class Roll20():
     This token must be supplied by the user, either in the $R20_CF_CLEARANCE environment variable, or when prompted.
     Tokens expire regularly, so you'll have to update it frequently. Alternatively you could use a fork of selenium which can pass Cloudflare checks.
     '''
+    @_on_driver_thread()
     def login(self, email=None, password=None, use_env=True) -> None:
         try:
             # Confirm that the cloudflare test has been passed by checking the title of the page. 
@@ -373,6 +795,7 @@ class Roll20():
             raise e
 
     # Precondition: must be logged in
+    @_on_driver_thread()
     def join_game(self, gameID: str) -> None:
         try:
             try:
@@ -404,8 +827,18 @@ class Roll20():
     def _initialise_chat(self) -> None:
         input_area = self.driver.find_element(By.ID, "textchat-input")
         self._chat_input = input_area.find_element(By.TAG_NAME, "textarea")
-        self._char_select = Select(input_area.find_element(By.ID, "speakingas"))
+        self._char_select_elem = input_area.find_element(By.ID, "speakingas")
+        self._char_select = Select(self._char_select_elem)
+        self._roster = None
         self._chat_send = input_area.find_element(By.ID, "chatSendBtn")
         self._chat_history = self.driver.find_element(By.ID, "openchatarchive")
         self._chat_window = self.driver.find_element(By.ID, "textchat").find_element(By.XPATH, "./div[@class='content']")
 
+        if(self._chat_only):
+            self.hide_tabletop()
+
+    # Stops the browser rendering the parts of the editor that the bot doesn't use
+    @_on_driver_thread()
+    def hide_tabletop(self) -> None:
+        self.driver.execute_script(HIDE_TABLETOP_SCRIPT, TABLETOP_ELEMENT_IDS)
+
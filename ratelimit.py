@@ -0,0 +1,84 @@
+import threading
+import time
+
+# Tokens reserved for a reply before it's requested, as its length isn't known until it arrives. Corrected once the request's usage is known
+EXPECTED_COMPLETION_TOKENS = 300
+
+RATE_LIMIT_POLICY_QUEUE = 'queue'
+RATE_LIMIT_POLICY_DROP = 'drop'
+
+# Holds up to `capacity` units, refilled continuously at a rate of `capacity` per `period` seconds.
+# The level can go below zero when more is used than was reserved, which delays later requests until it's paid back
+class TokenBucket():
+    def __init__(self, capacity: float, period: float=60):
+        self._capacity = capacity
+        self._rate = capacity / period
+        self._level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._level = min(self._capacity, self._level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    # Seconds until amount can be taken (0 if it can be taken now). Amounts larger than the capacity only need a full bucket
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        return max(0, (min(amount, self._capacity) - self._level) / self._rate)
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self._level -= amount
+
+    def give(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self._level = min(self._capacity, self._level + amount)
+
+# Keeps requests to one model within a requests-per-minute and tokens-per-minute budget. None means no limit.
+# Tokens are reserved before each request using an estimate, and the reservation is corrected with settle() once the actual usage is known.
+# Thread safe, so it can be shared between every game using the model
+class RateLimiter():
+    def __init__(self, requests_per_minute: int|None=None, tokens_per_minute: int|None=None):
+        self._condition = threading.Condition()
+        self._requests = (TokenBucket(requests_per_minute) if requests_per_minute != None else None)
+        self._tokens = (TokenBucket(tokens_per_minute) if tokens_per_minute != None else None)
+
+    # Reserves one request and `tokens` tokens. If wait is True, blocks until they're within the budget, 
+    # otherwise returns False (reserving nothing) if they aren't within it now
+    def acquire(self, tokens: int, wait: bool=True) -> bool:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                delay = max(self._requests.wait_time(1, now) if self._requests != None else 0,
+                            self._tokens.wait_time(tokens, now) if self._tokens != None else 0)
+                if(delay == 0):
+                    if(self._requests != None):
+                        self._requests.take(1, now)
+                    if(self._tokens != None):
+                        self._tokens.take(tokens, now)
+                    return True
+                if(not wait):
+                    return False
+                # Woken early if a settle() frees up tokens
+                self._condition.wait(delay)
+
+    # Corrects a reservation of `reserved` tokens made by acquire() once the request is known to have used `used` tokens
+    def settle(self, reserved: int, used: int) -> None:
+        if(self._tokens == None):
+            return
+        with self._condition:
+            now = time.monotonic()
+            if(used < reserved):
+                self._tokens.give(reserved - used, now)
+                self._condition.notify_all()
+            else:
+                self._tokens.take(used - reserved, now)
+
+_rate_limiters = dict()
+_rate_limiters_lock = threading.Lock()
+
+# Returns the rate limiter for model, shared by every game in this process. It's created with the given limits the first time it's requested
+def get_rate_limiter(model: str, requests_per_minute: int|None=None, tokens_per_minute: int|None=None) -> RateLimiter:
+    with _rate_limiters_lock:
+        if(model not in _rate_limiters):
+            _rate_limiters[model] = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+        return _rate_limiters[model]
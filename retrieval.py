@@ -0,0 +1,75 @@
+import re
+
+from messages import Message, MessageView
+
+TERM_PATTERN = re.compile(r"[^\W_]+")
+# Words too common to say anything about what a message is about
+STOPWORDS = frozenset('''a an and are as at be but by for from had has have he her him his i if in into is it its me my no not of on or our she so
+    that the their them then there they this to was we were what when where which who will with you your'''.split())
+
+# Only this many of the latest messages are used as the query
+QUERY_MESSAGE_COUNT = 5
+# Only this many of the best-scoring older messages are considered for the prompt
+CANDIDATE_COUNT = 50
+
+def get_terms(text: str) -> list[str]:
+    return [term for term in TERM_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+# Put in the prompt where messages have been left out, so that messages either side of the gap aren't read as following on from each other
+# (e.g. two messages by the same character being joined into one quote)
+GAP_MARKER = '[...]'
+
+# Picks prompt history from a MessageView (which must have a counter, and whose log must have a store): the latest messages, 
+# plus older messages that are relevant to them, found with the store's search index.
+# retrieval_share (less than 1) of the token limit is kept for the older messages; any of it they don't use goes to more recent messages.
+class ContextRetriever():
+    def __init__(self, view: MessageView, retrieval_share: float):
+        if(not 0 <= retrieval_share < 1):
+            raise ValueError("'retrieval_share' argument of ContextRetriever must be >= 0 and < 1")
+        self._view = view
+        self._retrieval_share = retrieval_share
+
+    @staticmethod
+    def _gap() -> Message:
+        return Message(GAP_MARKER, None, None, set())
+
+    def get_context(self, token_limit: int) -> list[Message]:
+        recent = self._view.get_token_messages(int(token_limit * (1 - self._retrieval_share)))
+        recent_start = (self._view.get_position(recent[0]) if len(recent) > 0 else None)
+        if(recent_start == None):
+            # e.g. the latest message alone costs more than the recent share of the limit
+            return self._view.get_token_messages(token_limit)
+
+        terms = sorted(set(get_terms(' '.join(msg.get_content() for msg in recent[-QUERY_MESSAGE_COUNT:]))))
+        remaining_tokens = token_limit - self._view.count_cost(recent)
+        # Each older message is charged for a gap marker too, as there may be one before each of them
+        gap_cost = self._view.count_cost([__class__._gap()])
+        older = []
+        older_tokens = 0
+        for score, position, message in self._view.search(terms, limit=CANDIDATE_COUNT, before=recent_start):
+            cost = self._view.count_cost([message]) + gap_cost
+            if(cost <= remaining_tokens):
+                older.append((position, message))
+                remaining_tokens -= cost
+                older_tokens += cost
+        if(len(older) == 0):
+            return self._view.get_token_messages(token_limit)
+
+        # Any tokens the older messages didn't use go to recent history, which may then reach back over some of them
+        recent = self._view.get_token_messages(token_limit - older_tokens)
+        recent_start = (self._view.get_position(recent[0]) if len(recent) > 0 else None)
+        if(recent_start == None):
+            return self._view.get_token_messages(token_limit)
+        older.sort(key=lambda item: item[0])
+        context = []
+        next_position = None
+        for position, message in older:
+            if(position >= recent_start):
+                break
+            if(next_position != None and position != next_position):
+                context.append(__class__._gap())
+            context.append(message)
+            next_position = position + 1
+        if(next_position != None and next_position != recent_start):
+            context.append(__class__._gap())
+        return context + recent
@@ -0,0 +1,91 @@
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+from generator import SentenceChunker
+from llm_client import END_OF_STREAM
+
+# Seconds without new messages before a reply is generated, so that a burst of messages gets one reply to all of it
+DEBOUNCE_QUIET_PERIOD = 2.0
+# Longest, in seconds, that a reply waits for the chat to go quiet
+DEBOUNCE_MAX_DELAY = 10.0
+# Times a reply can be cancelled and restarted because of new messages before it's let finish regardless, so that a busy chat still gets replies
+MAX_REPLY_RESTARTS = 2
+
+# Decides when to generate a reply. Triggers are held until there have been no new messages for quiet_period seconds,
+# or until max_delay seconds after the first trigger, and then all of them are answered with one reply
+class DebounceTimer():
+    def __init__(self, quiet_period: float=DEBOUNCE_QUIET_PERIOD, max_delay: float=DEBOUNCE_MAX_DELAY):
+        self._quiet_period = quiet_period
+        self._max_delay = max_delay
+        self._triggered_at = None
+        self._active_at = None
+
+    # A reply is wanted
+    def trigger(self) -> None:
+        now = time.monotonic()
+        if(self._triggered_at == None):
+            self._triggered_at = now
+        if(self._active_at == None):
+            self._active_at = now
+
+    # A new message was posted
+    def activity(self) -> None:
+        self._active_at = time.monotonic()
+
+    def is_pending(self) -> bool:
+        return self._triggered_at != None
+
+    def is_due(self) -> bool:
+        if(self._triggered_at == None):
+            return False
+        now = time.monotonic()
+        return (now - self._active_at >= self._quiet_period) or (now - self._triggered_at >= self._max_delay) # type: ignore
+
+    def reset(self) -> None:
+        self._triggered_at = None
+        self._active_at = None
+
+# A reply being generated. A non-streamed reply is read from its Future once it's done. A streamed reply's text is read from chunks 
+# (see LLMClient.submit_stream_chat_completion) as it arrives. Replies can be cancelled until some of them has been posted
+class PendingReply():
+    def __init__(self, future: Future, chunks: Queue|None, prompt_tokens: int, reserved_tokens: int):
+        self.future = future
+        self.chunks = chunks
+        self.prompt_tokens = prompt_tokens
+        self.reserved_tokens = reserved_tokens
+        self.started_at = time.monotonic()
+        self.chunker = (SentenceChunker() if chunks != None else None)
+        # Text streamed so far
+        self.text = []
+        # Usage the API reported at the end of the stream, if it has
+        self.usage = None
+        self.posted = False
+        self.finished = False
+
+    def is_streamed(self) -> bool:
+        return self.chunks != None
+
+    def cancel(self) -> None:
+        self.future.cancel()
+
+    # Returns the streamed text that has arrived since the last call, without waiting for more. Sets finished once the stream has ended.
+    # Raises APIError if the request failed
+    def take_chunks(self) -> list[str]:
+        taken = []
+        while(not self.finished):
+            try:
+                chunk = self.chunks.get_nowait() # type: ignore
+            except Empty:
+                break
+            if(chunk is END_OF_STREAM):
+                self.finished = True
+            elif(isinstance(chunk, BaseException)):
+                raise chunk
+            elif(isinstance(chunk, dict)):
+                self.usage = chunk
+            else:
+                taken.append(chunk)
+                # Kept as it's taken, so text that arrived before an error is still counted
+                self.text.append(chunk)
+        return taken
@@ -0,0 +1,234 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue
+
+# A stand-in for the chat completions API, so that how the bot copes with a slow or failing API can be checked locally without spending tokens.
+# Replies are canned. Faults are queued up, and each request takes the next one (if any):
+#   "<status>"               responds with that HTTP status, e.g. "503"
+#   "<status>:<seconds>"     also sends a Retry-After header, e.g. "429:2"
+#   "sleep:<seconds>"        waits before responding normally
+#   "cut"                    drops the connection (after the first chunk, for streamed requests)
+# Run it and set OPENAI_API_BASE to the URL it prints, or run it with --check to check LLMClient's retries, deadline and streaming against it.
+
+REPLY_TEXT = 'A stand-in reply. It is two sentences long.'
+
+class StandInAPI():
+    def __init__(self, port: int=0, latency: float=0):
+        self._latency = latency
+        self._faults = list()
+        self._lock = threading.Lock()
+        # Bodies of the requests received, in order
+        self.requests = list()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), __class__._make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def get_base_url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/v1'
+
+    def add_faults(self, *faults: str) -> None:
+        with self._lock:
+            self._faults.extend(faults)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(name='stand-in-api', daemon=True, target=self._server.serve_forever)
+        self._thread.start()
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _take_request(self, body: dict) -> str|None:
+        with self._lock:
+            self.requests.append(body)
+            return (self._faults.pop(0) if len(self._faults) > 0 else None)
+
+    @staticmethod
+    def _make_handler(api: 'StandInAPI'):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if(self.path.rstrip('/') != '/v1/chat/completions'):
+                    self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+                    return
+                fault = api._take_request(body)
+                time.sleep(api._latency)
+                if(fault != None and fault.startswith('sleep:')):
+                    time.sleep(float(fault.removeprefix('sleep:')))
+                elif(fault != None and fault != 'cut'):
+                    status, _, retry_after = fault.partition(':')
+                    self._send_json(int(status), {'error': {'message': f'Stand-in error {status}'}}, retry_after=(retry_after if retry_after != '' else None))
+                    return
+                if(body.get('stream')):
+                    self._stream(body, cut=(fault == 'cut'))
+                elif(fault == 'cut'):
+                    self.close_connection = True
+                else:
+                    self._send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': REPLY_TEXT}, 'finish_reason': 'stop'}],
+                                          'usage': __class__._usage(body)})
+
+            def _send_json(self, status: int, content: dict, retry_after: str|None=None) -> None:
+                data = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if(retry_after != None):
+                    self.send_header('Retry-After', retry_after)
+                self.end_headers()
+                self.wfile.write(data)
+
+            # Server-sent events, one word per chunk. Like the real API, the response uses chunked encoding, so a cut is seen as an error
+            def _stream(self, body: dict, cut: bool) -> None:
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                words = REPLY_TEXT.split(' ')
+                for i, word in enumerate(words):
+                    text = (word if i == len(words)-1 else word + ' ')
+                    self._send_event({'choices': [{'index': 0, 'delta': {'content': text}}]})
+                    if(cut):
+                        self.close_connection = True
+                        return
+                    time.sleep(api._latency / len(words))
+                if(body.get('stream_options', {}).get('include_usage')):
+                    self._send_event({'choices': [], 'usage': __class__._usage(body)})
+                self._send_chunk(b'data: [DONE]\n\n')
+                self._send_chunk(b'')
+
+            def _send_event(self, content: dict) -> None:
+                self._send_chunk(f'data: {json.dumps(content)}\n\n'.encode())
+
+            def _send_chunk(self, data: bytes) -> None:
+                self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                self.wfile.flush()
+
+            # Words stand in for tokens
+            @staticmethod
+            def _usage(body: dict) -> dict:
+                prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in body.get('messages', []))
+                completion_tokens = len(REPLY_TEXT.split())
+                return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+        return Handler
+
+# Runs LLMClient against a stand-in with faults injected, and prints whether it behaved as expected. Returns whether every check passed
+def check() -> bool:
+    import llm_client
+    from exceptions import APIError
+    from llm_client import LLMClient, END_OF_STREAM
+
+    # Short delays, so the checks only take a few seconds
+    llm_client.BACKOFF_BASE = 0.05
+    llm_client.BACKOFF_CAP = 0.2
+    api = StandInAPI()
+    api.start()
+    client = LLMClient(api_key='stand-in', api_base=api.get_base_url())
+    messages = [{'role': 'user', 'content': 'Hello there'}]
+    results = []
+
+    def report(name: str, passed: bool, detail='') -> None:
+        results.append(passed)
+        print(f'{"PASS" if passed else "FAIL"}: {name}' + (f' ({detail})' if detail != '' else ''))
+
+    # Returns (the response or APIError, the number of requests made, seconds taken)
+    def run(*faults: str, deadline: float|None=None):
+        api.requests.clear()
+        api.add_faults(*faults)
+        if(deadline != None):
+            llm_client.REQUEST_DEADLINE = deadline
+        start = time.monotonic()
+        try:
+            result = client.chat_completion(model='stand-in', messages=messages)
+        except APIError as error:
+            result = error
+        finally:
+            llm_client.REQUEST_DEADLINE = REQUEST_DEADLINE
+        return result, len(api.requests), time.monotonic() - start
+
+    def stream(*faults: str) -> list:
+        api.requests.clear()
+        api.add_faults(*faults)
+        chunks = Queue()
+        client.submit_stream_chat_completion(model='stand-in', messages=messages, chunks=chunks).result()
+        items = []
+        while(len(items) == 0 or not (items[-1] is END_OF_STREAM or isinstance(items[-1], APIError))):
+            items.append(chunks.get(timeout=10))
+        return items
+
+    REQUEST_DEADLINE = llm_client.REQUEST_DEADLINE
+    try:
+        result, requests, _ = run()
+        report('a request succeeds', isinstance(result, dict) and result['choices'][0]['message']['content'] == REPLY_TEXT)
+
+        result, requests, _ = run('503', '500')
+        report('transient errors are retried', isinstance(result, dict) and requests == 3, f'{requests} requests')
+
+        result, requests, _ = run('400')
+        report('client errors fail without retrying', isinstance(result, APIError) and not result.transient and requests == 1, f'{requests} requests')
+
+        result, requests, _ = run(*['503'] * llm_client.MAX_ATTEMPTS)
+        report('retries stop after MAX_ATTEMPTS', isinstance(result, APIError) and result.transient and requests == llm_client.MAX_ATTEMPTS, f'{requests} requests')
+
+        result, requests, seconds = run('429:1')
+        report('Retry-After is waited for', isinstance(result, dict) and seconds >= 1, f'{seconds:.2f}s')
+
+        result, requests, seconds = run('429:5', deadline=2)
+        report("retries that would pass the deadline aren't made", isinstance(result, APIError) and result.transient and requests == 1 and seconds < 1,
+               f'{requests} requests, {seconds:.2f}s')
+
+        result, requests, seconds = run('sleep:3', deadline=1)
+        report('a slow response times out at the deadline', isinstance(result, APIError) and result.transient and seconds < 2, f'{seconds:.2f}s')
+
+        result, requests, _ = run('cut', 'cut')
+        report('dropped connections are retried', isinstance(result, dict) and requests == 3, f'{requests} requests')
+
+        items = stream('502')
+        text = ''.join(item for item in items if isinstance(item, str))
+        usage = [item for item in items if isinstance(item, dict)]
+        report('a stream is retried until it starts', text == REPLY_TEXT and items[-1] is END_OF_STREAM and len(api.requests) == 2, f'{len(api.requests)} requests')
+        report('a stream reports its usage', len(usage) == 1 and usage[0]['completion_tokens'] > 0 and api.requests[-1].get('stream_options') == {'include_usage': True})
+
+        items = stream('cut')
+        report('a stream that is cut off ends with an error', isinstance(items[-1], APIError) and items[-1].transient and len(api.requests) == 1 and isinstance(items[0], str),
+               f'{len(api.requests)} requests')
+    finally:
+        client.close()
+        api.close()
+    print(f'{sum(results)}/{len(results)} checks passed')
+    return all(results)
+
+parser = argparse.ArgumentParser(
+    prog='stand_in_api',
+    description='A local stand-in for the chat completions API, which can be made slow or fail on purpose')
+parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+parser.add_argument('--latency', type=float, default=0, help='seconds each response takes')
+parser.add_argument('--fault', action='append', default=[], help='fault for the next request to take (see the top of stand_in_api.py). Can be given several times')
+parser.add_argument('--check', action='store_true', help="check LLMClient's retries, deadline and streaming against a stand-in, then exit")
+
+def main():
+    args = parser.parse_args()
+    if(args.check):
+        sys.exit(0 if check() else 1)
+    api = StandInAPI(port=args.port, latency=args.latency)
+    api.add_faults(*args.fault)
+    print(f'Listening on {api.get_base_url()}. Set OPENAI_API_BASE to this to use it')
+    try:
+        api.serve_forever()
+    except KeyboardInterrupt:
+        api.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import json
+import os
+
+from actor import Actor
+from exceptions import APIError
+from generator import Generator
+from messages import Message, MessageView, is_newer_id
+from ratelimit import RateLimiter, EXPECTED_COMPLETION_TOKENS
+from usage import UsageLedger
+
+# Messages are only summarised once at least this many tokens of them have aged out of the prompt window, so that each request is worth making
+SUMMARY_BATCH_TOKENS = 1000
+# Most tokens of messages summarised in one request. Any more wait for the next request
+SUMMARY_MAX_BATCH_TOKENS = 3000
+# With no checkpoint (e.g. the first time the bot plays a game), only this many tokens of messages from before the prompt window are summarised,
+# rather than the game's whole history
+SUMMARY_BACKFILL_TOKENS = 3000
+# Usage of summary requests is recorded under this name, alongside the game's characters
+SUMMARY_USAGE_NAME = '(summary)'
+
+# A running summary of the messages in a view that have aged out of the prompt window, so that the bot keeps some memory of them.
+# Messages are folded into the summary in batches by a request made on a background thread, so replies aren't held up.
+# The summary is checkpointed to <directory>/<gameID>.summary.json, with the id of the last message in it, so it carries on across restarts
+class RollingSummary():
+    def __init__(self, gameID: str, directory: str, view: MessageView, generator: Generator, model: str, 
+                 rate_limiter: RateLimiter|None=None, usage: UsageLedger|None=None):
+        self._gameID = gameID
+        self._directory = directory
+        self._path = os.path.join(directory, f'{gameID}.summary.json')
+        self._view = view
+        self._generator = generator
+        self._model = model
+        self._rate_limiter = rate_limiter
+        self._usage = usage
+        self._summary = ''
+        # id of the latest message in the summary
+        self._last_id = None
+        self._busy = False
+        self._worker = Actor(name=f'summary-{gameID}')
+        self._load()
+
+    def get_summary(self) -> str:
+        return self._summary
+
+    # Queues messages from before the window of the latest token_limit tokens that aren't in the summary yet to be summarised, 
+    # if there are enough of them. Does nothing if a batch is already being summarised
+    def update(self, token_limit: int) -> None:
+        if(self._busy):
+            return
+        window = self._view.get_token_messages(token_limit)
+        if(len(window) == 0 or window[0].get_id() == None):
+            return
+        if(self._last_id == None):
+            candidates = self._view.get_token_messages(token_limit + SUMMARY_BACKFILL_TOKENS)
+        else:
+            # Read lazily, as the checkpoint may be far behind, and only a batch is needed
+            candidates = self._view.iter_messages_after_id(self._last_id)
+
+        batch = []
+        batch_tokens = 0
+        for message in candidates:
+            if(message.get_id() == window[0].get_id()):
+                break
+            if(self._last_id != None and not is_newer_id(message.get_id(), than_id=self._last_id)):
+                continue
+            cost = self._view.count_cost([message])
+            if(len(batch) > 0 and batch_tokens + cost > SUMMARY_MAX_BATCH_TOKENS):
+                break
+            batch.append(message)
+            batch_tokens += cost
+        if(batch_tokens < SUMMARY_BATCH_TOKENS):
+            return
+
+        self._busy = True
+        self._worker.submit(self._fold, batch, batch_tokens)
+
+    def _fold(self, batch: list[Message], batch_tokens: int) -> None:
+        try:
+            reserved_tokens = batch_tokens + EXPECTED_COMPLETION_TOKENS
+            if(self._rate_limiter != None):
+                self._rate_limiter.acquire(tokens=reserved_tokens)
+            try:
+                response = self._generator.get_summary(summary=self._summary, messages=batch, model=self._model)
+            except APIError:
+                # Only the batch, which is most of the prompt, counts against the rate limit
+                if(self._rate_limiter != None):
+                    self._rate_limiter.settle(reserved=reserved_tokens, used=batch_tokens)
+                raise
+            usage = response['usage']
+            if(self._rate_limiter != None):
+                self._rate_limiter.settle(reserved=reserved_tokens, used=usage['total_tokens'])
+            if(self._usage != None):
+                self._usage.record(gameID=self._gameID, character=SUMMARY_USAGE_NAME, prompt_tokens=usage['prompt_tokens'], completion_tokens=usage['completion_tokens'])
+            self._summary = response['choices'][0]['message']['content'].strip()
+            self._last_id = batch[-1].get_id()
+            self._save()
+        except APIError as error:
+            # The same messages will be tried again on the next update
+            print(f'Failed to update the summary: {error}')
+        finally:
+            self._busy = False
+
+    def _load(self) -> None:
+        if(not os.path.exists(self._path)):
+            return
+        try:
+            with open(self._path, 'r', encoding='utf-8') as file:
+                checkpoint = json.load(file)
+            self._summary = checkpoint['summary']
+            self._last_id = checkpoint['last_id']
+        except (ValueError, KeyError):
+            print(f'Warning: Summary checkpoint "{self._path}" is unreadable. The summary will start again')
+
+    # Written to a temporary file first, so the checkpoint is never left half-written if the bot is killed
+    def _save(self) -> None:
+        os.makedirs(self._directory, exist_ok=True)
+        temporary_path = self._path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump({'summary': self._summary, 'last_id': self._last_id}, file)
+        os.replace(temporary_path, self._path)
@@ -0,0 +1,117 @@
+import base64
+import math
+from abc import ABC, abstractmethod
+import os
+import re
+from collections import OrderedDict
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+# Pre-tokenization pattern of cl100k_base, the encoding used by gpt-3.5-turbo and gpt-4
+CL100K_PATTERN = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+# The same pattern for the standard library's re module, which has no \p{..} classes. Letters are [^\W\d_], numbers \d, and anything else [\W_].
+# Only used if the `regex` package isn't installed. Counts may be slightly off for text with unusual Unicode categories
+CL100K_PATTERN_FALLBACK = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|(?:(?![\r\n])[\W_])?[^\W\d_]+|\d{1,3}| ?(?:(?!\s)[\W_])+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+
+PIECE_CACHE_SIZE = 100000
+# Most message counts memoized at once. The least recently used are dropped first
+MESSAGE_COUNT_CACHE_SIZE = 20000
+
+# Counts tokens in text. Counts for messages are memoized by message id, so each recently used message is only counted once
+# however many times it's used (Message.count_tokens, MessageLog.get_token_messages, prompt assembly).
+# Only the MESSAGE_COUNT_CACHE_SIZE most recently used counts are kept, so memory use doesn't grow with the campaign.
+# Counts of messages whose content is changed after being counted aren't updated.
+class TokenCounter(ABC):
+    def __init__(self):
+        self._message_counts = OrderedDict()
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        pass
+
+    def count_message(self, message) -> int:
+        id = message.get_id()
+        if(id == None):
+            return self.count(message.get_content())
+        count = self._message_counts.get(id)
+        if(count == None):
+            count = self.count(message.get_content())
+            self._message_counts[id] = count
+            if(len(self._message_counts) > MESSAGE_COUNT_CACHE_SIZE):
+                self._message_counts.popitem(last=False)
+        else:
+            self._message_counts.move_to_end(id)
+        return count
+
+    def __call__(self, text: str) -> int:
+        return self.count(text)
+
+# About 4 characters per token for English text. Used if no vocabulary is available
+class HeuristicTokenCounter(TokenCounter):
+    def count(self, text: str) -> int:
+        #This is only an approximation
+        return math.ceil(0.25*len(text))
+
+# Exact byte pair encoding token counts, using a vocabulary file in tiktoken's format (one "[base64 token] [rank]" per line).
+# e.g. https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken
+class BPETokenCounter(TokenCounter):
+    def __init__(self, vocabulary_path: str, pattern=CL100K_PATTERN):
+        super().__init__()
+        self._ranks = BPETokenCounter._load_ranks(vocabulary_path)
+        if(regex != None):
+            self._pattern = regex.compile(pattern)
+        else:
+            self._pattern = re.compile(CL100K_PATTERN_FALLBACK if pattern == CL100K_PATTERN else pattern)
+        # piece -> token count. Chat reuses the same words a lot, so most pieces are looked up here rather than merged
+        self._piece_counts = dict()
+
+    @staticmethod
+    def _load_ranks(vocabulary_path: str) -> dict[bytes, int]:
+        ranks = dict()
+        with open(vocabulary_path, 'rb') as file:
+            for line in file:
+                if(line.strip() == b''):
+                    continue
+                token, rank = line.split()
+                ranks[base64.b64decode(token)] = int(rank)
+        return ranks
+
+    def count(self, text: str) -> int:
+        count = 0
+        for piece in self._pattern.findall(text):
+            piece_count = self._piece_counts.get(piece)
+            if(piece_count == None):
+                piece_count = self._count_piece(piece.encode('utf-8'))
+                if(len(self._piece_counts) >= PIECE_CACHE_SIZE):
+                    self._piece_counts.clear()
+                self._piece_counts[piece] = piece_count
+            count += piece_count
+        return count
+
+    # Repeatedly merges the adjacent pair of parts with the lowest rank until no pair is in the vocabulary
+    def _count_piece(self, piece: bytes) -> int:
+        if(piece in self._ranks):
+            return 1
+        parts = [piece[i:i+1] for i in range(len(piece))]
+        while len(parts) > 1:
+            best_rank = None
+            best_index = None
+            for i in range(len(parts)-1):
+                rank = self._ranks.get(parts[i] + parts[i+1])
+                if(rank != None and (best_rank == None or rank < best_rank)):
+                    best_rank = rank
+                    best_index = i
+            if(best_index == None):
+                break
+            parts[best_index:best_index+2] = [parts[best_index] + parts[best_index+1]]
+        return len(parts)
+
+# Returns a BPETokenCounter if the vocabulary file exists, otherwise falls back to a HeuristicTokenCounter
+def get_token_counter(vocabulary_path: str|None) -> TokenCounter:
+    if(vocabulary_path != None and os.path.exists(vocabulary_path)):
+        return BPETokenCounter(vocabulary_path)
+    print(f'Tokenizer vocabulary "{vocabulary_path}" not found. Token counts will be approximate. See README.md for how to get it.')
+    return HeuristicTokenCounter()
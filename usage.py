@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+
+USAGE_FILE_NAME = 'usage.json'
+USAGE_FIELDS = ('requests', 'prompt_tokens', 'completion_tokens', 'total_tokens')
+
+# Running totals of API usage per game and per character, kept in a JSON file so that they carry on across restarts.
+# The file has the form {gameID: {character: {field: total for field in USAGE_FIELDS}}}
+class UsageLedger():
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._totals = dict()
+        if(os.path.exists(path)):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    self._totals = json.load(file)
+            except ValueError:
+                print(f'Warning: Usage file "{path}" is unreadable. Usage totals will start again from zero')
+
+    def record(self, gameID: str, character: str, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            totals = self._totals.setdefault(gameID, dict()).setdefault(character, dict.fromkeys(USAGE_FIELDS, 0))
+            totals['requests'] += 1
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+            totals['total_tokens'] += prompt_tokens + completion_tokens
+            self._save()
+
+    # Totals for one character in the game, or for the whole game if character is None
+    def get_totals(self, gameID: str, character: str|None=None) -> dict:
+        with self._lock:
+            game = self._totals.get(gameID, dict())
+            characters = ([game.get(character, dict())] if character != None else list(game.values()))
+            return {field : sum(totals.get(field, 0) for totals in characters) for field in USAGE_FIELDS}
+
+    # Written to a temporary file first, so the file is never left half-written if the bot is killed
+    def _save(self) -> None:
+        directory = os.path.dirname(self._path)
+        if(directory != ''):
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = self._path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(self._totals, file, indent=2)
+        os.replace(temporary_path, self._path)
+
+_ledgers = dict()
+_ledgers_lock = threading.Lock()
+
+# Returns the ledger kept in the file at path, shared by every game in this process
+def get_usage_ledger(path: str) -> UsageLedger:
+    with _ledgers_lock:
+        if(path not in _ledgers):
+            _ledgers[path] = UsageLedger(path)
+        return _ledgers[path]